@@ -5,23 +5,22 @@ set -e
 user="raiteilla"
 database="raiteilla"
 
-# Temporary file
-savetofile="autoupdate.cif"
-
-# Script starts
-lastday=`psql -d $database -U $user -AXqtc "SELECT extract(isodow FROM date_of_extract) FROM nrod.header ORDER BY date_of_extract DESC LIMIT 1"`
-nextday=$((lastday+1))
-
-echo "last=${lastday} next=${nextday}"
-
-if [[ $nextday -gt 7 ]]; then
-    nextday=1
+# Feed credentials come from the environment or from ~/.nrodrc, e.g.
+#   NROD_USERNAME="user@example.com"
+#   NROD_PASSWORD="secret"
+nrodrc="${HOME}/.nrodrc"
+if [ -f "${nrodrc}" ]; then
+    . "${nrodrc}"
 fi
+if [ -z "${NROD_USERNAME}" ] || [ -z "${NROD_PASSWORD}" ]; then
+    echo "Error: set NROD_USERNAME and NROD_PASSWORD in the environment or in ${nrodrc}" 1>&2
+    exit 1
+fi
+export NROD_USERNAME NROD_PASSWORD
 
-rm ${savetofile}
-
-CMD=(./getschedule.sh -o "${savetofile}.gz" -d ${nextday} -u)
-"${CMD[@]}"
-
-CMD=(python3 cifimport.py -d "${database}" -U "${user}" "${savetofile}")
+# Script starts
+# Downloads the update following the last import and streams it straight
+# into the database. The importer's continuity check rejects a file that
+# does not follow on from the last one imported.
+CMD=(python3 cifimport.py -q -d "${database}" -U "${user}" --fetch next)
 "${CMD[@]}"
@@ -0,0 +1,370 @@
+"""Benchmarks cifimport against a throwaway local PostgreSQL cluster.
+
+A temporary cluster is created with initdb and started with pg_ctl. For each
+file size, loader and batch size the nrod schema is recreated from init.sql,
+a generated full snapshot is imported and then an update on top of it. Each
+import reports its wall time, rows written per second per table and the WAL
+it generated, and the table and index sizes are reported after the update.
+"""
+
+import argparse
+from contextlib import redirect_stdout
+from datetime import date
+from time import monotonic
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import psycopg
+from cifimport import PostgresWriter, Progress, parse, sizeof_fmt
+
+TABLES = ["tiploc", "association", "schedule", "schedule_location", "changes_en_route"]
+
+START = date(2024, 1, 15)
+END = date(2024, 12, 14)
+
+
+# Helper Functions
+
+
+def int_list(value):
+    try:
+        return [int(v) for v in value.split(",") if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("{0} is not a list of numbers".format(value))
+
+
+def str_list(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def cif_date(d, reverse=False):
+    return d.strftime("%d%m%y" if reverse else "%y%m%d")
+
+
+def hhmm(minutes):
+    minutes %= 1440
+    return "{0:02d}{1:02d}".format(minutes // 60, minutes % 60)
+
+
+def line(*fields):
+    return "".join(fields).ljust(80)[:80] + "\n"
+
+
+# CIF file generator
+
+
+def header(ref, last_ref, update):
+    return line(
+        "HD",
+        "TPS.UDFROC1.PD{0}".format(cif_date(START)).ljust(20),
+        cif_date(START, reverse=True),
+        "2130",
+        ref,
+        last_ref.ljust(7),
+        "U" if update else "F",
+        "A",
+        cif_date(START, reverse=True),
+        cif_date(END, reverse=True),
+    )
+
+
+def tiploc(record, i):
+    code = "TIP{0:04d}".format(i)
+    return line(
+        record,
+        code,
+        "  ",
+        "{0:06d}".format(100000 + i),
+        "X",
+        "TIPLOC {0}".format(i).ljust(26),
+        "{0:05d}".format(10000 + i),
+        "    ",
+        "T{0:02d}".format(i % 100),
+        "Tiploc {0}".format(i).ljust(16),
+    )
+
+
+def association(transaction_type, i, tiplocs):
+    return line(
+        "AA",
+        transaction_type,
+        "A{0:05d}".format(i),
+        "A{0:05d}".format(i + 1),
+        cif_date(START),
+        cif_date(END),
+        "1111100",
+        "JJ",
+        "S",
+        "TIP{0:04d}".format(i % tiplocs),
+        " ",
+        " ",
+        "T",
+        "P",
+        " " * 31,
+        "P",
+    )
+
+
+def schedule(f, r, transaction_type, i, tiplocs):
+    f.write(line(
+        "BS",
+        transaction_type,
+        "A{0:05d}".format(i),
+        cif_date(START),
+        cif_date(END),
+        "1111100",
+        " ",
+        "P",
+        "OO",
+        "2A{0:02d}".format(i % 100),
+        "    ",
+        "1",
+        "21700001",
+        " ",
+        "EMU",
+        "375 ",
+        "100",
+        "D     ",
+        "S",
+        " ",
+        " ",
+        " ",
+        "    ",
+        "    ",
+        " ",
+        "P",
+    ))
+    if transaction_type == "D":
+        return
+    f.write(line("BX", "    ", "     ", "GW" if i % 2 else "XC", "Y"))
+    start = r.randint(0, 1439)
+    stops = r.sample(range(tiplocs), r.randint(2, 20))
+    codes = ["TIP{0:04d}".format(t) for t in stops]
+    f.write(line("LO", codes[0], " ", hhmm(start), " ", hhmm(start), "1  ", "   ", "  ", "  ", "TB".ljust(12), "  "))
+    for n, code in enumerate(codes[1:-1], 1):
+        m = start + n * 7
+        f.write(line("LI", code, " ", hhmm(m), " ", hhmm(m + 1), " ", "     ", hhmm(m), hhmm(m + 1),
+                     "2  ", "   ", "   ", "T".ljust(12)))
+        if n == 3:
+            f.write(line("CR", code, " ", "OO", "2A00", "    ", "1", "21700001", " ", "DMU", "158 ", "075"))
+    m = start + (len(codes) - 1) * 7
+    f.write(line("LT", codes[-1], " ", hhmm(m), " ", hhmm(m), "3  ", "   ", "TF".ljust(12)))
+
+
+def generate(path, schedules, update_share=None, seed=1):
+    """Writes a full snapshot of schedules, or an update to it revising
+    and deleting update_share of them."""
+    r = random.Random(seed if update_share is None else seed + 1)
+    tiplocs = max(50, schedules // 20)
+    update = update_share is not None
+    every = max(1, round(1 / update_share)) if update else 1
+    with open(path, "w", encoding="iso-8859-1") as f:
+        f.write(header("DFROC1B" if update else "DFROC1A", "DFROC1A" if update else "", update))
+        for i in range(0, tiplocs, every):
+            f.write(tiploc("TA" if update else "TI", i))
+        for i in range(0, schedules // 5, every):
+            f.write(association("R" if update else "N", i, tiplocs))
+        for i in range(0, schedules, every):
+            transaction_type = ("R" if i % 3 else "D") if update else "N"
+            schedule(f, r, transaction_type, i, tiplocs)
+        if update:
+            # New schedules
+            for i in range(schedules, schedules + schedules // every // 3):
+                schedule(f, r, "N", i, tiplocs)
+        f.write(line("ZZ"))
+
+
+# Cluster
+
+
+def find_pg_bin(path):
+    if path is None:
+        initdb = shutil.which("initdb")
+        if initdb is not None:
+            path = os.path.dirname(initdb)
+        elif shutil.which("pg_config") is not None:
+            path = subprocess.run(["pg_config", "--bindir"], capture_output=True,
+                                  text=True).stdout.strip()
+    if path is None or not os.path.isfile(os.path.join(path, "initdb")):
+        print("Error: initdb not found, give the PostgreSQL bin directory with --pg-bin",
+              file=sys.stderr)
+        sys.exit(1)
+    return path
+
+
+def pg(bin_dir, *args):
+    result = subprocess.run([os.path.join(bin_dir, args[0]), *args[1:]],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        print("Error: {0} failed:\n{1}".format(args[0], result.stderr or result.stdout),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+class Cluster:
+    """A temporary PostgreSQL cluster listening on a socket in its directory."""
+
+    def __init__(self, bin_dir, directory, port):
+        self.bin_dir = bin_dir
+        self.data = os.path.join(directory, "data")
+        self.socket = directory
+        self.log = os.path.join(directory, "postgresql.log")
+        self.port = port
+
+    def __enter__(self):
+        pg(self.bin_dir, "initdb", "-D", self.data, "-U", "bench", "-A", "trust",
+           "-E", "UTF8", "--no-sync")
+        options = "-p {0} -k {1} -c listen_addresses=''".format(self.port, self.socket)
+        pg(self.bin_dir, "pg_ctl", "-D", self.data, "-l", self.log, "-o", options, "-w", "start")
+        return self
+
+    def __exit__(self, *exc):
+        pg(self.bin_dir, "pg_ctl", "-D", self.data, "-m", "fast", "-w", "stop")
+
+    def connect(self, **kwargs):
+        return psycopg.connect(host=self.socket, port=self.port, user="bench",
+                               dbname="postgres", **kwargs)
+
+
+# Measurements
+
+
+def reset_schema(admin):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "init.sql")) as f:
+        init = f.read()
+    admin.execute("DROP SCHEMA IF EXISTS nrod CASCADE;")
+    admin.execute(init)
+    # Every import starts right after a checkpoint, so full page writes
+    # weigh the same in the WAL of each
+    admin.execute("CHECKPOINT;")
+
+
+def wal_lsn(admin):
+    return admin.execute("SELECT pg_current_wal_lsn();").fetchone()[0]
+
+
+def import_file(cluster, admin, path, loader, batch_size):
+    start = wal_lsn(admin)
+    with cluster.connect() as connection, open(os.devnull, "w") as devnull:
+        began = monotonic()
+        with open(path, encoding="iso-8859-1") as f, redirect_stdout(devnull):
+            parse(f, PostgresWriter(connection, loader=loader), Progress(mode="none"),
+                  batch_size=batch_size)
+        # Rows inserted and deleted by this transaction
+        rows = dict(
+            connection.execute(
+                """SELECT relname, n_tup_ins + n_tup_del FROM pg_stat_xact_user_tables
+                WHERE schemaname = 'nrod';"""
+            ).fetchall()
+        )
+        connection.commit()
+        elapsed = monotonic() - began
+    wal = admin.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s);",
+                        (start,)).fetchone()[0]
+    return elapsed, rows, int(wal)
+
+
+def table_sizes(admin):
+    return {
+        table: admin.execute(
+            "SELECT pg_table_size(%s), pg_indexes_size(%s);",
+            ("nrod." + table, "nrod." + table),
+        ).fetchone()
+        for table in TABLES
+    }
+
+
+def print_imports(results):
+    print("{0:>8} {1:<6} {2:<6} {3:>6} {4:>8} {5:>10}  {6}".format(
+        "size", "file", "loader", "batch", "seconds", "WAL", "  ".join(
+            "{0:>17}".format(t + "/s") for t in TABLES)))
+    for size, kind, loader, batch_size, elapsed, rows, wal in results:
+        print("{0:>8} {1:<6} {2:<6} {3:>6} {4:>8.2f} {5:>10}  {6}".format(
+            size, kind, loader, batch_size, elapsed, sizeof_fmt(wal), "  ".join(
+                "{0:>17.0f}".format(rows.get(t, 0) / elapsed) for t in TABLES)))
+
+
+def print_sizes(results):
+    print("{0:>8} {1:<6} {2:>6}  {3}".format(
+        "size", "loader", "batch", "  ".join("{0:>21}".format(t) for t in TABLES)))
+    for size, loader, batch_size, sizes in results:
+        print("{0:>8} {1:<6} {2:>6}  {3}".format(
+            size, loader, batch_size, "  ".join(
+                "{0:>21}".format("{0} + {1}".format(sizeof_fmt(data), sizeof_fmt(index)))
+                for data, index in (sizes[t] for t in TABLES))))
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        prog="cifbench", description="CIF Import Benchmark", conflict_handler="resolve")
+    ap.add_argument(
+        "--sizes",
+        type=int_list,
+        default=[1000, 10000, 50000],
+        help="numbers of schedules in the generated full files (default: 1000,10000,50000)",
+    )
+    ap.add_argument(
+        "--update-share",
+        type=float,
+        default=0.1,
+        help="share of the schedules revised or deleted by the update (default: %(default)s)",
+    )
+    ap.add_argument(
+        "--loaders",
+        type=str_list,
+        default=["insert", "copy"],
+        help="loader strategies to compare (default: insert,copy)",
+    )
+    ap.add_argument(
+        "--batch-sizes",
+        type=int_list,
+        default=[500, 2000, 10000],
+        help="batch sizes to compare (default: 500,2000,10000)",
+    )
+    ap.add_argument("--pg-bin", help="directory of initdb and pg_ctl (default: from PATH or pg_config)")
+    ap.add_argument("--port", type=int, default=54329, help="port of the cluster (default: %(default)s)")
+    args = ap.parse_args()
+
+    for loader in args.loaders:
+        if loader not in ("insert", "copy"):
+            ap.error("unknown loader {0}".format(loader))
+
+    bin_dir = find_pg_bin(args.pg_bin)
+
+    with tempfile.TemporaryDirectory(prefix="cifbench") as directory:
+        files = {}
+        for size in args.sizes:
+            full = os.path.join(directory, "full-{0}.cif".format(size))
+            update = os.path.join(directory, "update-{0}.cif".format(size))
+            generate(full, size)
+            generate(update, size, args.update_share)
+            files[size] = [("full", full), ("update", update)]
+            print("Generated {0} schedules: {1} full, {2} update".format(
+                size, sizeof_fmt(os.stat(full).st_size), sizeof_fmt(os.stat(update).st_size)))
+
+        imports = []
+        sizes = []
+        with Cluster(bin_dir, directory, args.port) as cluster:
+            with cluster.connect(autocommit=True) as admin:
+                for size in args.sizes:
+                    for loader in args.loaders:
+                        for batch_size in args.batch_sizes:
+                            reset_schema(admin)
+                            for kind, path in files[size]:
+                                print("Importing {0} {1} with {2}, batches of {3}...".format(
+                                    size, kind, loader, batch_size), file=sys.stderr)
+                                imports.append((size, kind, loader, batch_size,
+                                                *import_file(cluster, admin, path, loader, batch_size)))
+                            sizes.append((size, loader, batch_size, table_sizes(admin)))
+
+    print("\nImports (rows inserted and deleted per second)\n")
+    print_imports(imports)
+    print("\nTable + index sizes after the update\n")
+    print_sizes(sizes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,551 @@
+"""Turns a full CIF snapshot into an update.
+
+The snapshot is compared with the database, or with the previous snapshot
+file, and only the tiplocs, associations and schedules that differ are
+written to a CIF update file, which is then imported like a daily update.
+Records are compared by 64-bit digests of their natural key and content.
+The digests of the new snapshot are kept in sorted arrays, under 32 bytes a
+record, and the old records are streamed against them.
+"""
+
+import argparse
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from heapq import merge
+from operator import itemgetter
+import os
+import sys
+import tempfile
+import psycopg
+from cifimport import SCHEDULE_COLUMNS as IMPORT_SCHEDULE_COLUMNS
+from cifimport import (
+    CHANGE_COLUMNS,
+    ITERSIZE,
+    LOCATION_COLUMNS,
+    Association,
+    Header,
+    PostgresWriter,
+    Progress,
+    Schedule,
+    Tiploc,
+    add_connection_arguments,
+    connection_dsn,
+    parse,
+    select_last_ref,
+    sizeof_fmt,
+)
+
+# Columns compared, in the order of their INSERT statements
+
+TIPLOC_COLUMNS = [
+    "nalco",
+    "check_char",
+    "tps_description",
+    "stanox",
+    "crs_code",
+    "description",
+]
+
+ASSOCIATION_COLUMNS = [
+    "main_train_uid",
+    "assoc_train_uid",
+    "assoc_start_date",
+    "assoc_end_date",
+    "assoc_days",
+    "category",
+    "date_indicator",
+    "location",
+    "base_location_suffix",
+    "assoc_location_suffix",
+    "association_type",
+    "stp_indicator",
+]
+
+# The import sets last_modified, it is not part of the content
+SCHEDULE_COLUMNS = [c for c in IMPORT_SCHEDULE_COLUMNS if c != "last_modified"]
+
+# Natural key of a database schedule row, which starts with the id
+schedule_key = itemgetter(
+    *(SCHEDULE_COLUMNS.index(c) + 1 for c in ("train_uid", "schedule_start_date", "stp_indicator")))
+
+SCHEDULE_RECORDS = ("BX", "TN", "LO", "LI", "LT", "CR", "LN")
+
+MASK = (1 << 64) - 1
+
+# Digests sorted at a time as Python objects
+CHUNK = 65536
+
+# Status of the records of the new snapshot after the comparison
+NEW = 0
+SAME = 1
+REVISED = 2
+REPLACED = 3  # Associations sharing a key, deleted and inserted again
+
+
+# Helper Functions
+
+
+def text(value):
+    # Same text as a ::text cast in PostgreSQL
+    if value is None:
+        return ""
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    return str(value)
+
+
+def row_text(values):
+    return "\x1f".join(map(text, values)).encode()
+
+
+def digest(*rows):
+    h = blake2b(digest_size=8)
+    for row in rows:
+        h.update(row)
+        h.update(b"\x1e")
+    return int.from_bytes(h.digest(), "little")
+
+
+def key_digest(entity, key):
+    return digest(row_text([entity, *key]))
+
+
+def schedule_digest(schedule, locations, changes):
+    # Changes en route have no position in the database, compare them sorted
+    return digest(
+        row_text(schedule),
+        *(row_text(l) for l in locations),
+        b"\x1d",
+        *sorted(row_text(c) for c in changes),
+    )
+
+
+def cif_date(value):
+    # YYYY-MM-DD to the yymmdd of CIF records
+    return value[2:4] + value[5:7] + value[8:10]
+
+
+def record_line(fields):
+    # fields maps a start column to its text
+    line = [" "] * 80
+    for start, value in fields.items():
+        line[start:start + len(value)] = value
+    return "".join(line) + "\n"
+
+
+def open_cif(filename):
+    return open(filename, "r", encoding="iso-8859-1", errors="ignore")
+
+
+# Record sources
+
+
+def snapshot_records(f):
+    """Yields (entity, key, digest) for the records of a CIF file."""
+
+    def schedule(bs):
+        values = vars(bs)
+        return (
+            "S",
+            bs.key(),
+            schedule_digest(
+                [values[c] for c in SCHEDULE_COLUMNS],
+                bs.locations,
+                bs.changes,
+            ),
+        )
+
+    bs = None
+    for line in f:
+        record = line[0:2]
+
+        if record in SCHEDULE_RECORDS:
+            if bs is None:
+                continue
+            if record == "BX":
+                bs.set_bx(line)
+            else:
+                bs.add_record(record, line)
+            if record == "LT":
+                yield schedule(bs)
+                bs = None
+            continue
+
+        # Any other record closes a schedule without locations
+        if bs is not None:
+            yield schedule(bs)
+            bs = None
+
+        if record == "TI" or record == "TA":
+            t = Tiploc(line)
+            values = vars(t)
+            yield "T", [t.new_tiploc], digest(row_text([values[c] for c in TIPLOC_COLUMNS]))
+
+        elif record == "AA":
+            aa = Association(line)
+            if aa.transaction_type != "D":
+                values = vars(aa)
+                yield "A", aa.key(), digest(row_text([values[c] for c in ASSOCIATION_COLUMNS]))
+
+        elif record == "BS":
+            s = Schedule(line)
+            if s.transaction_type != "D":
+                bs = s
+
+    if bs is not None:
+        yield schedule(bs)
+
+
+def text_columns(columns):
+    return ", ".join(f"{c}::text" for c in columns)
+
+
+def database_records(connection, user_start_date):
+    """Yields (entity, key, digest) for the records in the database.
+
+    Schedules that the import will delete as historic are left out, and so
+    are VSTP schedules, which CIF files do not contain.
+    """
+    with connection.cursor(name="cifdiff_tiploc") as cursor:
+        cursor.itersize = ITERSIZE
+        cursor.execute(
+            f"SELECT tiploc_code, {text_columns(TIPLOC_COLUMNS)} FROM nrod.tiploc;")
+        for row in cursor:
+            yield "T", [row[0]], digest(row_text(row[1:]))
+
+    with connection.cursor(name="cifdiff_association") as cursor:
+        cursor.itersize = ITERSIZE
+        cursor.execute(
+            f"""SELECT main_train_uid, assoc_train_uid, assoc_start_date::text,
+            location, stp_indicator, {text_columns(ASSOCIATION_COLUMNS)}
+            FROM nrod.association;"""
+        )
+        for row in cursor:
+            yield "A", list(row[0:5]), digest(row_text(row[5:]))
+
+    # Schedules, locations and changes en route are merged in schedule id order
+    schedules = connection.cursor(name="cifdiff_schedule")
+    locations = connection.cursor(name="cifdiff_location")
+    changes = connection.cursor(name="cifdiff_changes")
+    with schedules, locations, changes:
+        for cursor in (schedules, locations, changes):
+            cursor.itersize = ITERSIZE
+        schedules.execute(
+            f"""SELECT id, {text_columns(SCHEDULE_COLUMNS)} FROM nrod.schedule
+            WHERE is_vstp = FALSE AND (schedule_end_date IS NULL OR
+            schedule_end_date >= %s::date - INTERVAL '1 day')
+            ORDER BY id;""",
+            (user_start_date,),
+        )
+        locations.execute(
+            f"""SELECT schedule_id, {text_columns(LOCATION_COLUMNS)}
+            FROM nrod.schedule_location ORDER BY schedule_id, position;"""
+        )
+        changes.execute(
+            f"""SELECT schedule_id, {text_columns(CHANGE_COLUMNS)}
+            FROM nrod.changes_en_route ORDER BY schedule_id;"""
+        )
+        location = next(locations, None)
+        change = next(changes, None)
+        for row in schedules:
+            id = row[0]
+            schedule_locations = []
+            schedule_changes = []
+            # Skip child rows of schedules left out
+            while location is not None and location[0] <= id:
+                if location[0] == id:
+                    schedule_locations.append(location[1:])
+                location = next(locations, None)
+            while change is not None and change[0] <= id:
+                if change[0] == id:
+                    schedule_changes.append(change[1:])
+                change = next(changes, None)
+            key = list(schedule_key(row))
+            yield "S", key, schedule_digest(row[1:], schedule_locations, schedule_changes)
+
+
+# Diff
+
+
+def sorted_digests(records):
+    """Sorts (key, digest, add) triples by key into two arrays.
+
+    The triples are sorted a chunk at a time and the chunks merged, so only
+    one chunk is held as Python objects. Digests sharing a key are summed
+    when add is set, otherwise the last one is kept.
+    """
+    chunks = []
+    chunk = []
+
+    def flush():
+        chunk.sort(key=itemgetter(0))
+        chunks.append((
+            array("Q", (r[0] for r in chunk)),
+            array("Q", (r[1] for r in chunk)),
+            bytes(r[2] for r in chunk),
+        ))
+        chunk.clear()
+
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= CHUNK:
+            flush()
+    if chunk:
+        flush()
+
+    keys = array("Q")
+    digests = array("Q")
+    # Ties keep the order of the chunks, and so of the records
+    for key, d, add in merge(*(zip(*c) for c in chunks), key=itemgetter(0)):
+        if keys and keys[-1] == key:
+            digests[-1] = (digests[-1] + d) & MASK if add else d
+        else:
+            keys.append(key)
+            digests.append(d)
+    return keys, digests
+
+
+def find(keys, key):
+    i = bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+        return i
+    return None
+
+
+def index_snapshot(filename):
+    """Returns the key digests of the records of a snapshot in sorted order,
+    and their content digests."""
+    with open_cif(filename) as f:
+        # Several associations can share a key, combine them
+        return sorted_digests(
+            (key_digest(entity, key), d, entity == "A")
+            for entity, key, d in snapshot_records(f)
+        )
+
+
+def compare(keys, digests, old_records, deletes):
+    """Compares old records against the index of the new snapshot.
+
+    Delete records for the old records missing from the new snapshot are
+    written to deletes. Returns their number and the status of each record
+    of the new snapshot.
+    """
+    status = bytearray(len(keys))
+    # Key digests of the missing associations, deleted once per key
+    missing = set()
+    count = 0
+
+    def old_associations():
+        nonlocal count
+        # Associations are compared once all sharing a key have been read
+        for entity, key, d in old_records:
+            kd = key_digest(entity, key)
+            i = find(keys, kd)
+            if entity == "A":
+                if i is not None:
+                    yield i, d, True
+                    continue
+                if kd in missing:
+                    continue
+                missing.add(kd)
+            elif i is not None and status[i] == NEW:
+                status[i] = SAME if digests[i] == d else REVISED
+                continue
+            deletes.write(delete_line(entity, key))
+            count += 1
+
+    positions, old_digests = sorted_digests(old_associations())
+    for i, d in zip(positions, old_digests):
+        status[i] = SAME if digests[i] == d else REPLACED
+
+    return count, status
+
+
+def update_header(line, last_ref):
+    # The update follows on from the data it is compared with
+    if last_ref is None:
+        last_ref = line[39:46]
+    return line[:39] + last_ref.ljust(7)[:7] + "U" + line[47:]
+
+
+def delete_line(entity, key):
+    if entity == "T":
+        return record_line({0: "TD", 2: key[0]})
+    if entity == "A":
+        main_train_uid, assoc_train_uid, assoc_start_date, location, stp_indicator = key
+        return record_line({
+            0: "AAD",
+            3: main_train_uid,
+            9: assoc_train_uid,
+            15: cif_date(assoc_start_date),
+            37: location,
+            79: stp_indicator,
+        })
+    train_uid, schedule_start_date, stp_indicator = key
+    return record_line({
+        0: "BSD",
+        3: train_uid,
+        9: cif_date(schedule_start_date),
+        79: stp_indicator,
+    })
+
+
+def write_update(filename, output, last_ref, deletes, keys, status):
+    with open_cif(filename) as f, open(output, "w", encoding="iso-8859-1") as o:
+        o.write(update_header(f.readline(), last_ref))
+        deletes.seek(0)
+        for line in deletes:
+            o.write(line)
+
+        def changed(entity, key):
+            return status[find(keys, key_digest(entity, key))]
+
+        emit = False  # Write the records of the current schedule
+        for line in f:
+            record = line[0:2]
+
+            if record in SCHEDULE_RECORDS:
+                if emit:
+                    o.write(line)
+                continue
+            emit = False
+
+            if record == "TI" or record == "TA":
+                t = Tiploc(line)
+                kind = changed("T", [t.new_tiploc])
+                if kind != SAME:
+                    # Written under its current code, without a rename
+                    kind = "TA" if kind == REVISED else "TI"
+                    o.write(kind + t.new_tiploc.ljust(7) + line[9:72] + " " * 7 + line[79:])
+
+            elif record == "AA":
+                aa = Association(line)
+                if aa.transaction_type != "D":
+                    i = find(keys, key_digest("A", aa.key()))
+                    if status[i] == REPLACED:
+                        # The old associations sharing the key go first
+                        o.write(delete_line("A", aa.key()))
+                        status[i] = NEW
+                    if status[i] == NEW:
+                        o.write("AAN" + line[3:])
+
+            elif record == "BS":
+                bs = Schedule(line)
+                if bs.transaction_type != "D":
+                    kind = changed("S", bs.key())
+                    if kind == REVISED:
+                        o.write("BSR" + line[3:])
+                        emit = True
+                    elif kind == NEW:
+                        o.write("BSN" + line[3:])
+                        emit = True
+
+            elif record == "ZZ":
+                o.write(line)
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        prog="cifdiff", description="CIF Snapshot Diff Tool", conflict_handler="resolve")
+    ap.add_argument("filename", help="new full CIF snapshot")
+    ap.add_argument(
+        "--previous",
+        required=False,
+        help="compare with this earlier snapshot instead of the database",
+    )
+    ap.add_argument(
+        "-o",
+        "--output",
+        required=False,
+        help="write the update to this file (default: a temporary file)",
+    )
+
+    # Postgres related arguments, the update is imported when given
+    add_connection_arguments(ap, required=False)
+    ap.add_argument("-t", required=False, action="store_true",
+                    help="test only without committing")
+    ap.add_argument(
+        "--progress",
+        choices=["bar", "json", "none"],
+        default="bar",
+        required=False,
+        help="progress reporting while importing the update",
+    )
+    args = ap.parse_args()
+
+    if args.dbname is None and (args.previous is None or args.output is None):
+        ap.error("without a database give both --previous and --output")
+    if args.dbname is not None and args.username is None:
+        ap.error("the following arguments are required: -U/--username")
+    for filename in (args.filename, args.previous):
+        if filename is not None and os.path.isfile(filename) != True:
+            print("Error: {0} is not a file!".format(filename), file=sys.stderr)
+            sys.exit(1)
+
+    with open_cif(args.filename) as f:
+        first_line = f.readline()
+    if first_line.startswith("HD") != True:
+        print("Error: {0} is not a CIF Schedule file!".format(
+            args.filename), file=sys.stderr)
+        sys.exit(1)
+    hd = Header(first_line)
+
+    print("Indexing {0}...".format(args.filename))
+    keys, digests = index_snapshot(args.filename)
+    print("Records: {0}".format(len(keys)))
+
+    connection = None
+    if args.dbname is not None:
+        connection = psycopg.connect(connection_dsn(args))
+
+    # Delete records are collected on disk until the update is written
+    deletes = tempfile.TemporaryFile("w+", encoding="iso-8859-1")
+    try:
+        if args.previous is not None:
+            print("Comparing with {0}...".format(args.previous))
+            with open_cif(args.previous) as f:
+                last_ref = Header(f.readline()).current_file_reference
+                f.seek(0)
+                missing, status = compare(keys, digests, snapshot_records(f), deletes)
+        else:
+            print("Comparing with the database...")
+            last_ref = select_last_ref(connection)
+            missing, status = compare(
+                keys, digests, database_records(connection, hd.user_start_date), deletes)
+        del digests
+
+        replaced = status.count(REPLACED)
+        print("Deletes: {0}".format(missing + replaced))
+        print("Revisions: {0}".format(status.count(REVISED)))
+        print("Inserts: {0}".format(status.count(NEW) + replaced))
+
+        output = args.output
+        if output is None:
+            fd, output = tempfile.mkstemp(suffix=".cif")
+            os.close(fd)
+        write_update(args.filename, output, last_ref, deletes, keys, status)
+        print("Update written to {0} ({1})\n".format(
+            output, sizeof_fmt(os.stat(output).st_size)))
+
+        if connection is not None:
+            with open_cif(output) as f:
+                parse(f, PostgresWriter(connection),
+                      Progress(os.stat(output).st_size, args.progress))
+            # If a test then rollback otherwise commit
+            if args.t == True:
+                connection.rollback()
+            else:
+                connection.commit()
+            if args.output is None:
+                os.remove(output)
+    finally:
+        deletes.close()
+        if connection is not None:
+            connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,26 @@
 import argparse
+from base64 import b64encode
 from collections import Counter
+from contextlib import ExitStack, redirect_stdout
 from datetime import date, time
 from getpass import getpass
+from itertools import chain
+from operator import attrgetter, itemgetter
+from queue import Queue
+from threading import Thread
+from time import monotonic
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
 from tqdm import tqdm
+import gzip
+import io
 import os
 import json
 import sys
+import sqlite3
 import psycopg
+from psycopg.conninfo import conninfo_to_dict
 
 # Helper Functions
 
@@ -127,6 +141,15 @@ class Association:
         self.association_type = str_fmt(raw[47:48])
         self.stp_indicator = str_fmt(raw[79:80])
 
+    def key(self):
+        return [
+            self.main_train_uid,
+            self.assoc_train_uid,
+            self.assoc_start_date,
+            self.location,
+            self.stp_indicator,
+        ]
+
 
 class Schedule:
     def __init__(self, raw):
@@ -159,6 +182,12 @@ class Schedule:
         # Child rows
         self.locations = []
         self.changes = []
+        # Day count since the origin, and the last time seen
+        self.current_day = 0
+        self.last_processed_time = None
+
+    def key(self):
+        return [self.train_uid, self.schedule_start_date, self.stp_indicator]
 
     def set_bx(self, raw):
         self.uic_code = str_fmt(raw[6:11])
@@ -170,15 +199,40 @@ class Schedule:
 
     def add_location(self, obj):
         if isinstance(obj, OriginLocation):
-            self.locations.append(vars(obj))
-        elif isinstance(obj, IntermediateLocation):
-            self.locations.append(vars(obj))
-        elif isinstance(obj, TerminatingLocation):
-            self.locations.append(vars(obj))
+            # It is day 0
+            obj.departure_day = 0
+            # Set departure as previous time
+            self.last_processed_time = obj.departure
+            self.locations.append(location_row(obj))
+        elif isinstance(obj, (IntermediateLocation, TerminatingLocation)):
+            # Process arrival time
+            if obj.arrival:
+                obj.arrival_day = self.next_day(obj.arrival)
+            # Process departure time
+            if obj.departure:
+                obj.departure_day = self.next_day(obj.departure)
+            self.locations.append(location_row(obj))
+
+    def next_day(self, time):
+        # A time earlier than the previous one has passed midnight
+        if self.last_processed_time is not None and time < self.last_processed_time:
+            self.current_day += 1
+        self.last_processed_time = time
+        return self.current_day
 
     def add_changes(self, obj):
         if isinstance(obj, ChangesEnRoute):
-            self.changes.append(vars(obj))
+            self.changes.append(change_row(obj))
+
+    def add_record(self, record, raw):
+        if record == "LO":
+            self.add_location(OriginLocation(raw))
+        elif record == "LI":
+            self.add_location(IntermediateLocation(raw))
+        elif record == "LT":
+            self.add_location(TerminatingLocation(raw))
+        elif record == "CR":
+            self.add_changes(ChangesEnRoute(raw))
 
 
 class OriginLocation:
@@ -258,6 +312,142 @@ class ChangesEnRoute:
         self.uic_code = str_fmt(raw[62:67])
 
 
+# Rows
+
+# Schedules move from the parser to the writers as (schedule, locations,
+# changes) tuples of rows, the columns in the order of the INSERT statements
+
+SCHEDULE_COLUMNS = [
+    "train_uid",
+    "schedule_start_date",
+    "schedule_end_date",
+    "schedule_days_runs",
+    "train_status",
+    "train_category",
+    "signalling_id",
+    "train_service_code",
+    "power_type",
+    "timing_load",
+    "speed",
+    "operating_characteristics",
+    "train_class",
+    "sleepers",
+    "reservations",
+    "catering_code",
+    "service_branding",
+    "stp_indicator",
+    "uic_code",
+    "atoc_code",
+    "applicable_timetable",
+    "last_modified",
+]
+
+LOCATION_COLUMNS = [
+    "tiploc_code",
+    "tiploc_instance",
+    "arrival_day",
+    "departure_day",
+    "arrival",
+    "departure",
+    "public_arrival",
+    "public_departure",
+    "platform",
+    "line",
+    "path",
+    "activity",
+    "engineering_allowance",
+    "pathing_allowance",
+    "performance_allowance",
+]
+
+CHANGE_COLUMNS = [
+    "tiploc_code",
+    "tiploc_instance",
+    "train_category",
+    "signalling_id",
+    "train_service_code",
+    "power_type",
+    "timing_load",
+    "speed",
+    "operating_characteristics",
+    "train_class",
+    "sleepers",
+    "reservations",
+    "catering_code",
+    "service_branding",
+    "uic_code",
+]
+
+schedule_row = attrgetter(*SCHEDULE_COLUMNS)
+location_row = attrgetter(*LOCATION_COLUMNS)
+change_row = attrgetter(*CHANGE_COLUMNS)
+
+
+def location_rows(schedules, ids):
+    # Child rows are numbered while they stream to executemany
+    for (_, locations, _), id in zip(schedules, ids):
+        for position, location in enumerate(locations):
+            yield (id, position, *location)
+
+
+def change_rows(schedules, ids):
+    for (_, _, changes), id in zip(schedules, ids):
+        for change in changes:
+            yield (id, *change)
+
+
+# Filters
+
+LOCATION_RECORDS = ("LO", "LI", "LT", "CR")
+
+
+class Filter:
+    """Selects the associations and schedules to import.
+
+    atoc_codes and tiplocs are sets, None accepting everything. TIPLOCs whose
+    STANOX falls in one of stanox_ranges, given as (first, last) pairs, are
+    added to tiplocs. date_from and date_to are YYYY-MM-DD strings. Deletes
+    are never filtered.
+    """
+
+    def __init__(self, atoc_codes=None, tiplocs=None, stanox_ranges=None, date_from=None, date_to=None):
+        self.atoc_codes = atoc_codes
+        self.tiplocs = tiplocs
+        self.stanox_ranges = stanox_ranges or []
+        if self.stanox_ranges and self.tiplocs is None:
+            self.tiplocs = set()
+        self.date_from = date_from
+        self.date_to = date_to
+
+    @property
+    def active(self):
+        return (
+            self.atoc_codes is not None
+            or self.tiplocs is not None
+            or self.date_from is not None
+            or self.date_to is not None
+        )
+
+    def add_tiploc(self, tiploc):
+        # Keep the area up to date with TIPLOCs inserted or amended by the file
+        if tiploc.stanox is not None and any(
+            first <= tiploc.stanox <= last for first, last in self.stanox_ranges
+        ):
+            self.tiplocs.add(tiploc.new_tiploc)
+
+    def dates(self, start, end):
+        if self.date_to is not None and start is not None and start > self.date_to:
+            return False
+        if self.date_from is not None and end is not None and end < self.date_from:
+            return False
+        return True
+
+    def association(self, aa):
+        if not self.dates(aa.assoc_start_date, aa.assoc_end_date):
+            return False
+        return self.tiplocs is None or aa.location in self.tiplocs
+
+
 # Database functions
 
 
@@ -276,12 +466,96 @@ def select_last_ref(connection):
     return None
 
 
+def select_last_extract(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """SELECT date_of_extract
+            FROM nrod.header
+            ORDER BY date_of_extract DESC LIMIT 1;"""
+        )
+        one = cursor.fetchone()
+        if one:
+            return one[0]
+    return None
+
+
+def select_tiplocs_by_stanox(connection, ranges):
+    tiplocs = set()
+    with connection.cursor() as cursor:
+        for first, last in ranges:
+            cursor.execute(
+                "SELECT tiploc_code FROM nrod.tiploc WHERE stanox BETWEEN %s AND %s;",
+                (first, last),
+            )
+            tiplocs.update(row[0] for row in cursor.fetchall())
+    return tiplocs
+
+
+# Rows fetched per round trip by server-side cursors
+ITERSIZE = 100000
+
+
+def select_schedule_ids(connection):
+    with connection.cursor(name="cifimport_schedule_ids") as cursor:
+        cursor.itersize = ITERSIZE
+        cursor.execute(
+            """SELECT train_uid, schedule_start_date::text, stp_indicator, id
+            FROM nrod.schedule WHERE is_vstp = FALSE;"""
+        )
+        return {(uid, start, stp): id for uid, start, stp, id in cursor}
+
+
+def select_association_ids(connection):
+    ids = {}
+    with connection.cursor(name="cifimport_association_ids") as cursor:
+        cursor.itersize = ITERSIZE
+        cursor.execute(
+            """SELECT main_train_uid, assoc_train_uid, assoc_start_date::text,
+            location, stp_indicator, id FROM nrod.association;"""
+        )
+        for *key, id in cursor:
+            ids.setdefault(tuple(key), []).append(id)
+    return ids
+
+
+# Indexes the deletes by natural key rely on, see init.sql
+DELETE_INDEXES = [
+    ("tiploc", ["tiploc_code"]),
+    ("association", ["main_train_uid", "assoc_train_uid", "assoc_start_date", "location", "stp_indicator"]),
+    ("schedule", ["train_uid", "schedule_start_date", "stp_indicator", "is_vstp"]),
+    ("schedule_location", ["schedule_id"]),
+    ("changes_en_route", ["schedule_id"]),
+]
+
+
+def missing_indexes(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """SELECT c.relname, array(
+                SELECT a.attname FROM unnest(i.indkey) WITH ORDINALITY AS k(attnum, n)
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                ORDER BY k.n)
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'nrod';"""
+        )
+        indexes = cursor.fetchall()
+    # Any order of the key columns leading an index will do
+    return [
+        (table, columns)
+        for table, columns in DELETE_INDEXES
+        if not any(t == table and set(c[:len(columns)]) == set(columns) for t, c in indexes)
+    ]
+
+
 def truncate_tables(connection):
     with connection.cursor() as cursor:
         cursor.execute("TRUNCATE nrod.association;")
         cursor.execute("TRUNCATE nrod.header;")
         cursor.execute("DELETE FROM nrod.schedule WHERE is_vstp = FALSE;")
         cursor.execute("TRUNCATE nrod.tiploc;")
+        cursor.execute("TRUNCATE nrod.change_log;")
 
 
 def insert_header(connection, data):
@@ -322,13 +596,13 @@ def insert_tiplocs(connection, data):
         )
 
 
-def delete_tiplocs(connection, data):
+def delete_tiplocs(connection, data, log=print):
     with connection.cursor() as cursor:
         for d in data:
             cursor.execute(
                 "DELETE FROM nrod.tiploc WHERE tiploc_code = %(tiploc_code)s;", d)
             if cursor.rowcount == 0:
-                print("Tiploc Delete ({0}) affected 0 rows".format(
+                log("Tiploc Delete ({0}) affected 0 rows".format(
                     d["tiploc_code"]))
 
 
@@ -369,7 +643,7 @@ def insert_associations(connection, data):
         )
 
 
-def delete_associations(connection, associations):
+def delete_associations(connection, associations, report_missing=True, log=print):
     with connection.cursor() as cursor:
         for a in associations:
             cursor.execute(
@@ -386,8 +660,8 @@ def delete_associations(connection, associations):
                     a["stp_indicator"],
                 ),
             )
-            if cursor.rowcount == 0:
-                print(
+            if cursor.rowcount == 0 and report_missing:
+                log(
                     "Association {0} ({1}, {2}, {3}, {4}, {5}) affected 0 rows".format(
                         a["transaction_type"],
                         a["main_train_uid"],
@@ -399,6 +673,63 @@ def delete_associations(connection, associations):
                 )
 
 
+def delete_associations_by_id(connection, ids):
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM nrod.association WHERE id = ANY(%s);", (ids,))
+
+
+def copy_rows(connection, table, columns, rows):
+    with connection.cursor() as cursor:
+        with cursor.copy("COPY {0} ({1}) FROM STDIN".format(table, ", ".join(columns))) as copy:
+            for row in rows:
+                copy.write_row(row)
+
+
+def copy_tiplocs(connection, data):
+    row = itemgetter(
+        "new_tiploc",
+        "nalco",
+        "check_char",
+        "tps_description",
+        "stanox",
+        "crs_code",
+        "description",
+    )
+    copy_rows(
+        connection,
+        "nrod.tiploc",
+        [
+            "tiploc_code",
+            "nalco",
+            "check_char",
+            "tps_description",
+            "stanox",
+            "crs_code",
+            "description",
+        ],
+        (row(d) for d in data),
+    )
+
+
+def copy_associations(connection, data):
+    columns = [
+        "main_train_uid",
+        "assoc_train_uid",
+        "assoc_start_date",
+        "assoc_end_date",
+        "assoc_days",
+        "category",
+        "date_indicator",
+        "location",
+        "base_location_suffix",
+        "assoc_location_suffix",
+        "association_type",
+        "stp_indicator",
+    ]
+    row = itemgetter(*columns)
+    copy_rows(connection, "nrod.association", columns, (row(d) for d in data))
+
+
 def returning_id_generator(cursor):
     while True:
         yield cursor.fetchone()[0]
@@ -406,7 +737,10 @@ def returning_id_generator(cursor):
             break
 
 
-def insert_schedules(connection, schedules):
+def insert_schedules(connection, schedules, loader="insert", log=print):
+    # A batch of deletes only has nothing to return
+    if not schedules:
+        return
     with connection.cursor() as cursor:
         cursor.executemany(
             """
@@ -436,86 +770,96 @@ def insert_schedules(connection, schedules):
                 last_modified
             )
             VALUES (
-                FALSE,
-                %(train_uid)s,
-                %(schedule_start_date)s,
-                %(schedule_end_date)s,
-                %(schedule_days_runs)s,
-                %(train_status)s,
-                %(train_category)s,
-                %(signalling_id)s,
-                %(train_service_code)s,
-                %(power_type)s,
-                %(timing_load)s,
-                %(speed)s,
-                %(operating_characteristics)s,
-                %(train_class)s,
-                %(sleepers)s,
-                %(reservations)s,
-                %(catering_code)s,
-                %(service_branding)s,
-                %(stp_indicator)s,
-                %(uic_code)s,
-                %(atoc_code)s,
-                %(applicable_timetable)s,
-                %(last_modified)s
+                FALSE, %s, %s, %s, %s, %s, %s, %s,
+                %s, %s, %s, %s, %s, %s, %s, %s,
+                %s, %s, %s, %s, %s, %s, %s
             ) RETURNING id;
         """,
-            schedules,
+            (row for row, _, _ in schedules),
             returning=True,
         )
 
         # Collect returning id's
         returning = [id for id in returning_id_generator(cursor)]
         if len(returning) != len(schedules):
-            print("Schedule ID's mismatched during insert!")
+            log("Schedule ID's mismatched during insert!", file=sys.stderr)
             sys.exit(1)
-        # Assign schedule_id's to respective locations/changes
-        locations = []
-        changes = []
-        for s, id in zip(schedules, returning):
-            locations.extend([{**d, "schedule_id": id, "position": pos}
-                             for pos, d in enumerate(s["locations"])])
-            changes.extend([{**d, "schedule_id": id} for d in s["changes"]])
-        # Insert locations/changes
-        insert_schedule_locations(connection, locations)
-        insert_changes_en_route(connection, changes)
-
-
-def delete_schedules(connection, schedules):
+        # Insert locations/changes under their schedule_id's
+        locations = location_rows(schedules, returning)
+        changes = change_rows(schedules, returning)
+        if loader == "copy":
+            copy_rows(connection, "nrod.schedule_location",
+                      ["schedule_id", "position", *LOCATION_COLUMNS], locations)
+            copy_rows(connection, "nrod.changes_en_route",
+                      ["schedule_id", *CHANGE_COLUMNS], changes)
+        else:
+            insert_schedule_locations(connection, locations)
+            insert_changes_en_route(connection, changes)
+
+
+def delete_schedules(connection, schedules, report_missing=True, log=print):
     with connection.cursor() as cursor:
-        for s in schedules:
+        for transaction_type, *key in schedules:
             cursor.execute(
                 """
                 DELETE FROM nrod.schedule
-                WHERE is_vstp = FALSE AND train_uid = %(train_uid)s AND
-                schedule_start_date = %(schedule_start_date)s AND
-                stp_indicator = %(stp_indicator)s;
+                WHERE is_vstp = FALSE AND train_uid = %s AND
+                schedule_start_date = %s AND stp_indicator = %s;
             """,
-                s,
+                key,
             )
-            if cursor.rowcount == 0:
-                print(
-                    "Schedule {0} ({1}, {2}, {3}) affected 0 rows".format(
-                        s["transaction_type"],
-                        s["train_uid"],
-                        s["schedule_start_date"],
-                        s["stp_indicator"],
-                    )
-                )
+            if cursor.rowcount == 0 and report_missing:
+                log("Schedule {0} ({1}, {2}, {3}) affected 0 rows".format(
+                    transaction_type, *key))
+
+
+def delete_schedules_by_id(connection, ids):
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM nrod.schedule WHERE id = ANY(%s);", (ids,))
 
 
-def delete_old_schedules(connection, date):
+def delete_old_schedules(connection, date, log=print):
     with connection.cursor() as cursor:
         cursor.execute(
             """
             DELETE FROM nrod.schedule WHERE is_vstp IS FALSE AND
-            schedule_end_date < %s::date - INTERVAL '1 day';
+            schedule_end_date < %s::date - INTERVAL '1 day'
+            RETURNING train_uid, schedule_start_date::text, stp_indicator;
         """,
             (date,),
         )
-        print("Deleted {0} schedules that have become historic".format(
+        log("Deleted {0} schedules that have become historic".format(
             cursor.rowcount))
+        # Keys of the deleted schedules
+        return [list(row) for row in cursor.fetchall()]
+
+
+def insert_change_log(connection, file_reference, changes):
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            """
+            INSERT INTO nrod.change_log (
+                file_reference,
+                entity,
+                transaction_type,
+                key
+            ) VALUES (%s, %s, %s, %s);
+        """,
+            [(file_reference, *c) for c in changes],
+        )
+
+
+def delete_old_change_log(connection, keep):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            DELETE FROM nrod.change_log WHERE file_reference NOT IN (
+                SELECT current_file_reference FROM nrod.header
+                ORDER BY date_of_extract DESC, time_of_extract DESC LIMIT %s
+            );
+        """,
+            (keep,),
+        )
 
 
 def insert_schedule_locations(connection, locations):
@@ -541,23 +885,9 @@ def insert_schedule_locations(connection, locations):
                 pathing_allowance,
                 performance_allowance
             ) VALUES (
-                %(schedule_id)s,
-                %(position)s,
-                %(tiploc_code)s,
-                %(tiploc_instance)s,
-                %(arrival_day)s,
-                %(departure_day)s,
-                %(arrival)s,
-                %(departure)s,
-                %(public_arrival)s,
-                %(public_departure)s,
-                %(platform)s,
-                %(line)s,
-                %(path)s,
-                %(activity)s,
-                %(engineering_allowance)s,
-                %(pathing_allowance)s,
-                %(performance_allowance)s
+                %s, %s, %s, %s, %s, %s, %s, %s,
+                %s, %s, %s, %s, %s, %s, %s, %s,
+                %s
             );
         """,
             locations,
@@ -586,38 +916,670 @@ def insert_changes_en_route(connection, changes):
                 service_branding,
                 uic_code
             ) VALUES (
-                %(schedule_id)s,
-                %(tiploc_code)s,
-                %(tiploc_instance)s,
-                %(train_category)s,
-                %(signalling_id)s,
-                %(train_service_code)s,
-                %(power_type)s,
-                %(timing_load)s,
-                %(speed)s,
-                %(operating_characteristics)s,
-                %(train_class)s,
-                %(sleepers)s,
-                %(reservations)s,
-                %(catering_code)s,
-                %(service_branding)s,
-                %(uic_code)s
+                %s, %s, %s, %s, %s, %s, %s, %s,
+                %s, %s, %s, %s, %s, %s, %s, %s
             );
         """,
             changes,
         )
 
 
+# Writers
+
+
+class ContinuityError(Exception):
+    pass
+
+
+class Writer:
+    """Writes the batches of one import to a target database.
+
+    Backends implement the select_*, insert_* and delete_* methods along
+    with truncate_tables(), commit() and rollback().
+    """
+
+    name = None
+    # Set by FanOutWriter, so that the messages of several targets can be
+    # told apart
+    prefix_messages = False
+
+    def log(self, message, **kwargs):
+        if self.prefix_messages:
+            message = "{0}: {1}".format(self.name, message)
+        # One write per line keeps the lines of writer threads apart
+        print(message + "\n", end="", **kwargs)
+
+    def tiplocs_by_stanox(self, ranges):
+        return self.select_tiplocs_by_stanox(ranges)
+
+    def begin(self, hd, log_changes):
+        # Continuity check
+        last_ref = self.select_last_ref()
+        if last_ref != None and last_ref != hd.last_file_reference:
+            raise ContinuityError(
+                "Continuity error: last file ref did not match {0} in the database".format(last_ref))
+
+        # Delete schedules ending before the time window
+        historic = self.delete_old_schedules(hd.user_start_date)
+        if log_changes and historic:
+            self.insert_change_log(hd.current_file_reference,
+                                   [("S", "D", key) for key in historic])
+
+    def write(self, batch):
+        report_missing = batch.get("report_missing", True)
+        if "tiplocs" in batch:
+            deletes, inserts = batch["tiplocs"]
+            self.delete_tiplocs(deletes)
+            self.insert_tiplocs(inserts)
+        if "associations" in batch:
+            deletes, inserts = batch["associations"]
+            self.delete_associations(deletes, report_missing)
+            self.insert_associations(inserts)
+        if "schedules" in batch:
+            deletes, inserts = batch["schedules"]
+            self.delete_schedules(deletes, report_missing)
+            self.insert_schedules(inserts)
+        if "change_log" in batch:
+            file_reference, changes = batch["change_log"]
+            self.insert_change_log(file_reference, changes)
+
+    def finish(self, header, change_log_keep):
+        self.insert_header(header)
+        # None for full snapshots, which are not logged
+        if change_log_keep is not None:
+            self.delete_old_change_log(change_log_keep)
+
+    def close(self):
+        pass
+
+
+class PostgresWriter(Writer):
+    """Writer for a PostgreSQL database set up with init.sql.
+
+    loader is "insert" for INSERT statements or "copy" to load tiplocs,
+    associations, locations and changes en route with COPY. Updates map the
+    natural keys of schedules and associations to their ids once, and delete
+    by id where a key is mapped.
+    """
+
+    def __init__(self, connection, name=None, loader="insert"):
+        self.connection = connection
+        self.name = name
+        self.loader = loader
+        self.failures = {}
+        self.schedule_ids = None
+        self.association_ids = None
+
+    def begin(self, hd, log_changes):
+        for table, columns in missing_indexes(self.connection):
+            self.log("Warning: no index on nrod.{0} ({1}), deletes will scan the table".format(
+                table, ", ".join(columns)), file=sys.stderr)
+        super().begin(hd, log_changes)
+        if hd.update_indicator == "U":
+            self.schedule_ids = select_schedule_ids(self.connection)
+            self.association_ids = select_association_ids(self.connection)
+
+    def select_last_ref(self):
+        return select_last_ref(self.connection)
+
+    def select_last_extract(self):
+        return select_last_extract(self.connection)
+
+    def select_tiplocs_by_stanox(self, ranges):
+        return select_tiplocs_by_stanox(self.connection, ranges)
+
+    def truncate_tables(self):
+        truncate_tables(self.connection)
+
+    def insert_header(self, data):
+        insert_header(self.connection, data)
+
+    def insert_tiplocs(self, data):
+        if self.loader == "copy":
+            copy_tiplocs(self.connection, data)
+        else:
+            insert_tiplocs(self.connection, data)
+
+    def delete_tiplocs(self, data):
+        delete_tiplocs(self.connection, data, self.log)
+
+    def insert_associations(self, data):
+        if self.loader == "copy":
+            copy_associations(self.connection, data)
+        else:
+            insert_associations(self.connection, data)
+
+    def delete_associations(self, associations, report_missing=True):
+        if self.association_ids is None:
+            delete_associations(self.connection, associations, report_missing, self.log)
+            return
+        ids = []
+        unmapped = []
+        for a in associations:
+            # A key is only mapped until it is deleted, rows inserted since
+            # then are deleted by key
+            key = (
+                a["main_train_uid"],
+                a["assoc_train_uid"],
+                a["assoc_start_date"],
+                a["location"],
+                a["stp_indicator"],
+            )
+            mapped = self.association_ids.pop(key, None)
+            if mapped is None:
+                unmapped.append(a)
+            else:
+                ids.extend(mapped)
+        if ids:
+            delete_associations_by_id(self.connection, ids)
+        delete_associations(self.connection, unmapped, report_missing, self.log)
+
+    def insert_schedules(self, schedules):
+        insert_schedules(self.connection, schedules, self.loader, self.log)
+
+    def delete_schedules(self, schedules, report_missing=True):
+        if self.schedule_ids is None:
+            delete_schedules(self.connection, schedules, report_missing, self.log)
+            return
+        ids = []
+        unmapped = []
+        for s in schedules:
+            id = self.schedule_ids.pop(tuple(s[1:]), None)
+            if id is None:
+                unmapped.append(s)
+            else:
+                ids.append(id)
+        if ids:
+            delete_schedules_by_id(self.connection, ids)
+        delete_schedules(self.connection, unmapped, report_missing, self.log)
+
+    def delete_old_schedules(self, date):
+        return delete_old_schedules(self.connection, date, self.log)
+
+    def insert_change_log(self, file_reference, changes):
+        insert_change_log(self.connection, file_reference, changes)
+
+    def delete_old_change_log(self, keep):
+        delete_old_change_log(self.connection, keep)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+
+class SqliteWriter(Writer):
+    """Writer for an embedded SQLite file with the tables of init_sqlite.sql.
+
+    Tuned for a one-off bulk load: everything is written in one transaction
+    with the rollback journal in memory and without syncing to disk, so an
+    interrupted load leaves a file that should be rebuilt.
+    """
+
+    def __init__(self, path, name=None):
+        # Used from a FanOutWriter thread, but only by one thread at a time
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.name = name or path
+        self.failures = {}
+        for pragma in [
+            "journal_mode = MEMORY",
+            "synchronous = OFF",
+            "temp_store = MEMORY",
+            "cache_size = -262144",
+            "locking_mode = EXCLUSIVE",
+            "foreign_keys = ON",
+        ]:
+            self.connection.execute("PRAGMA {0};".format(pragma))
+        schema = os.path.join(os.path.dirname(os.path.abspath(__file__)), "init_sqlite.sql")
+        with open(schema) as f:
+            self.connection.executescript(f.read())
+
+    def select_last_ref(self):
+        one = self.connection.execute(
+            """SELECT current_file_reference FROM header
+            WHERE update_indicator = ?
+            ORDER BY date_of_extract DESC LIMIT 1;""",
+            ["U"],
+        ).fetchone()
+        return one[0] if one else None
+
+    def select_last_extract(self):
+        one = self.connection.execute(
+            "SELECT date_of_extract FROM header ORDER BY date_of_extract DESC LIMIT 1;"
+        ).fetchone()
+        return date.fromisoformat(one[0]) if one else None
+
+    def select_tiplocs_by_stanox(self, ranges):
+        tiplocs = set()
+        for first, last in ranges:
+            rows = self.connection.execute(
+                "SELECT tiploc_code FROM tiploc WHERE stanox BETWEEN ? AND ?;",
+                (first, last),
+            )
+            tiplocs.update(row[0] for row in rows)
+        return tiplocs
+
+    def truncate_tables(self):
+        self.connection.execute("DELETE FROM association;")
+        self.connection.execute("DELETE FROM header;")
+        self.connection.execute("DELETE FROM schedule WHERE is_vstp = 0;")
+        self.connection.execute("DELETE FROM tiploc;")
+        self.connection.execute("DELETE FROM change_log;")
+
+    def insert_header(self, data):
+        self.connection.execute(
+            """
+            INSERT INTO header VALUES (
+                :file_mainframe_identity,
+                :date_of_extract,
+                :time_of_extract,
+                :current_file_reference,
+                :last_file_reference,
+                :update_indicator,
+                :user_start_date,
+                :user_end_date,
+                :statistics
+            );
+        """,
+            data,
+        )
+
+    def insert_tiplocs(self, data):
+        self.connection.executemany(
+            """
+            INSERT INTO tiploc VALUES (
+                :new_tiploc,
+                :nalco,
+                :check_char,
+                :tps_description,
+                :stanox,
+                :crs_code,
+                :description
+            );
+        """,
+            data,
+        )
+
+    def delete_tiplocs(self, data):
+        for d in data:
+            cursor = self.connection.execute(
+                "DELETE FROM tiploc WHERE tiploc_code = :tiploc_code;", d)
+            if cursor.rowcount == 0:
+                self.log("Tiploc Delete ({0}) affected 0 rows".format(
+                    d["tiploc_code"]))
+
+    def insert_associations(self, data):
+        self.connection.executemany(
+            """
+            INSERT INTO association (
+                main_train_uid,
+                assoc_train_uid,
+                assoc_start_date,
+                assoc_end_date,
+                assoc_days,
+                category,
+                date_indicator,
+                location,
+                base_location_suffix,
+                assoc_location_suffix,
+                association_type,
+                stp_indicator
+            )
+            VALUES (
+                :main_train_uid,
+                :assoc_train_uid,
+                :assoc_start_date,
+                :assoc_end_date,
+                :assoc_days,
+                :category,
+                :date_indicator,
+                :location,
+                :base_location_suffix,
+                :assoc_location_suffix,
+                :association_type,
+                :stp_indicator
+            );
+        """,
+            data,
+        )
+
+    def delete_associations(self, associations, report_missing=True):
+        for a in associations:
+            cursor = self.connection.execute(
+                """
+                DELETE FROM association
+                WHERE main_train_uid = ? AND assoc_train_uid = ? AND
+                assoc_start_date = ? AND location = ? AND stp_indicator = ?;
+            """,
+                (
+                    a["main_train_uid"],
+                    a["assoc_train_uid"],
+                    a["assoc_start_date"],
+                    a["location"],
+                    a["stp_indicator"],
+                ),
+            )
+            if cursor.rowcount == 0 and report_missing:
+                self.log(
+                    "Association {0} ({1}, {2}, {3}, {4}, {5}) affected 0 rows".format(
+                        a["transaction_type"],
+                        a["main_train_uid"],
+                        a["assoc_train_uid"],
+                        a["assoc_start_date"],
+                        a["location"],
+                        a["stp_indicator"],
+                    )
+                )
+
+    def insert_schedules(self, schedules):
+        cursor = self.connection.cursor()
+        ids = []
+        for row, _, _ in schedules:
+            # lastrowid needs one statement per schedule, the statement is
+            # prepared once and SQLite has no round trip to save
+            cursor.execute(
+                """
+                INSERT INTO schedule (
+                    is_vstp,
+                    train_uid,
+                    schedule_start_date,
+                    schedule_end_date,
+                    schedule_days_runs,
+                    train_status,
+                    train_category,
+                    signalling_id,
+                    train_service_code,
+                    power_type,
+                    timing_load,
+                    speed,
+                    operating_characteristics,
+                    train_class,
+                    sleepers,
+                    reservations,
+                    catering_code,
+                    service_branding,
+                    stp_indicator,
+                    uic_code,
+                    atoc_code,
+                    applicable_timetable,
+                    last_modified
+                )
+                VALUES (
+                    0, ?, ?, ?, ?, ?, ?, ?,
+                    ?, ?, ?, ?, ?, ?, ?, ?,
+                    ?, ?, ?, ?, ?, ?, ?
+                );
+            """,
+                row,
+            )
+            ids.append(cursor.lastrowid)
+        cursor.executemany(
+            """
+            INSERT INTO schedule_location (
+                schedule_id,
+                position,
+                tiploc_code,
+                tiploc_instance,
+                arrival_day,
+                departure_day,
+                arrival,
+                departure,
+                public_arrival,
+                public_departure,
+                platform,
+                line,
+                path,
+                activity,
+                engineering_allowance,
+                pathing_allowance,
+                performance_allowance
+            ) VALUES (
+                ?, ?, ?, ?, ?, ?, ?, ?,
+                ?, ?, ?, ?, ?, ?, ?, ?,
+                ?
+            );
+        """,
+            location_rows(schedules, ids),
+        )
+        cursor.executemany(
+            """
+            INSERT INTO changes_en_route (
+                schedule_id,
+                tiploc_code,
+                tiploc_instance,
+                train_category,
+                signalling_id,
+                train_service_code,
+                power_type,
+                timing_load,
+                speed,
+                operating_characteristics,
+                train_class,
+                sleepers,
+                reservations,
+                catering_code,
+                service_branding,
+                uic_code
+            ) VALUES (
+                ?, ?, ?, ?, ?, ?, ?, ?,
+                ?, ?, ?, ?, ?, ?, ?, ?
+            );
+        """,
+            change_rows(schedules, ids),
+        )
+
+    def delete_schedules(self, schedules, report_missing=True):
+        for transaction_type, *key in schedules:
+            cursor = self.connection.execute(
+                """
+                DELETE FROM schedule
+                WHERE is_vstp = 0 AND train_uid = ? AND
+                schedule_start_date = ? AND stp_indicator = ?;
+            """,
+                key,
+            )
+            if cursor.rowcount == 0 and report_missing:
+                self.log("Schedule {0} ({1}, {2}, {3}) affected 0 rows".format(
+                    transaction_type, *key))
+
+    def delete_old_schedules(self, date):
+        where = "is_vstp = 0 AND schedule_end_date < date(?, '-1 day')"
+        keys = [
+            list(row)
+            for row in self.connection.execute(
+                "SELECT train_uid, schedule_start_date, stp_indicator FROM schedule WHERE {0};".format(where),
+                (date,),
+            )
+        ]
+        self.connection.execute(
+            "DELETE FROM schedule WHERE {0};".format(where), (date,))
+        self.log("Deleted {0} schedules that have become historic".format(len(keys)))
+        return keys
+
+    def insert_change_log(self, file_reference, changes):
+        self.connection.executemany(
+            "INSERT INTO change_log VALUES (?, ?, ?, ?);",
+            [(file_reference, entity, transaction_type, json.dumps(key))
+             for entity, transaction_type, key in changes],
+        )
+
+    def delete_old_change_log(self, keep):
+        self.connection.execute(
+            """
+            DELETE FROM change_log WHERE file_reference NOT IN (
+                SELECT current_file_reference FROM header
+                ORDER BY date_of_extract DESC, time_of_extract DESC LIMIT ?
+            );
+        """,
+            (keep,),
+        )
+
+    def commit(self):
+        self.connection.commit()
+        self.connection.execute("PRAGMA optimize;")
+
+    def rollback(self):
+        self.connection.rollback()
+
+
+class FanOutWriter:
+    """Hands the batches of one import to a thread per target Writer.
+
+    Each target has its own transaction. A target that fails is rolled back
+    and left out of the rest of the import, its error kept in failures.
+    """
+
+    def __init__(self, writers, depth=16):
+        self.writers = writers
+        for w in writers:
+            w.prefix_messages = True
+        self.failures = {}
+        self.queues = [Queue(depth) for _ in writers]
+        self.threads = [
+            Thread(target=self.run, args=(w, q), daemon=True)
+            for w, q in zip(writers, self.queues)
+        ]
+        for t in self.threads:
+            t.start()
+
+    def run(self, writer, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                break
+            if writer.name in self.failures:
+                continue
+            method, args = task
+            try:
+                getattr(writer, method)(*args)
+            except ContinuityError as e:
+                self.fail(writer, str(e))
+            except psycopg.Error as e:
+                self.fail(writer, "SQL Error: {0} {1}".format(
+                    e.sqlstate, e.diag.message_primary))
+            except sqlite3.Error as e:
+                self.fail(writer, "SQL Error: {0}".format(e))
+            except Exception as e:
+                self.fail(writer, "{0}: {1}".format(type(e).__name__, e))
+            except SystemExit:
+                self.fail(writer, "Import stopped")
+
+    def fail(self, writer, message):
+        self.failures[writer.name] = message
+        try:
+            writer.rollback()
+        except (psycopg.Error, sqlite3.Error):
+            pass
+
+    def submit(self, method, *args):
+        if len(self.failures) == len(self.writers):
+            print("All targets failed, changes not committed", file=sys.stderr)
+            sys.exit(1)
+        for q in self.queues:
+            q.put((method, args))
+
+    def tiplocs_by_stanox(self, ranges):
+        # Called before any batch is queued, so the connection is free
+        return self.writers[0].tiplocs_by_stanox(ranges)
+
+    def begin(self, hd, log_changes):
+        self.submit("begin", hd, log_changes)
+
+    def write(self, batch):
+        self.submit("write", batch)
+
+    def finish(self, header, change_log_keep):
+        self.submit("finish", header, change_log_keep)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        # Wait for the targets to write everything queued
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+
+
+# Progress
+
+
+class Progress:
+    """Reports parsing progress each time the byte offset crosses a step.
+
+    mode is "bar" for a tqdm progress bar, "json" for a stream of JSON lines
+    on stderr, or "none". total is the input size in bytes when it is known.
+    source, if given, returns the position to report instead of the parser's
+    offset, e.g. compressed bytes received when total is a Content-Length.
+    """
+
+    def __init__(self, total=None, mode="bar", step=4194304, stream=None, source=None):
+        self.total = total
+        self.mode = mode
+        self.step = step
+        self.source = source
+        self.stream = stream if stream is not None else sys.stderr
+        self.offset = 0
+        self.started = monotonic()
+        # The parser only calls update() once next_offset has been reached
+        self.next_offset = step if mode != "none" else float("inf")
+        self.pbar = None
+        if mode == "bar":
+            self.pbar = tqdm(total=total, desc="Processing",
+                             unit="B", unit_scale=True, unit_divisor=1024)
+
+    def update(self, offset):
+        position = self.source() if self.source is not None else offset
+        if self.pbar is not None:
+            self.pbar.update(position - self.offset)
+        self.offset = position
+        self.next_offset = offset + self.step
+        if self.mode == "json":
+            self.emit("progress")
+
+    def emit(self, event, **extra):
+        elapsed = monotonic() - self.started
+        rate = self.offset / elapsed if elapsed > 0 else 0
+        eta = None
+        if self.total and rate > 0:
+            eta = round(max(self.total - self.offset, 0) / rate, 1)
+        record = {
+            "event": event,
+            "bytes": self.offset,
+            "total": self.total,
+            "percent": round(100 * self.offset / self.total, 1) if self.total else None,
+            "elapsed": round(elapsed, 1),
+            "rate": round(rate),
+            "eta": eta,
+            **extra,
+        }
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+    def close(self, offset, **extra):
+        if self.mode != "none":
+            self.update(offset)
+        if self.mode == "json":
+            self.emit("done", **extra)
+        if self.pbar is not None:
+            self.pbar.close()
+
+
 # Parser
-def parse(f, connection):
-    # Count lines
-    f.seek(0)
-    total_lines = sum(bl.count("\n") for bl in blocks(f))
-    print("Total lines: {0}".format(total_lines))
+def parse(f, writer, progress=None, change_log_keep=14, filters=None, batch_size=2000):
+    if progress is None:
+        progress = Progress(mode="none")
+    if filters is None:
+        filters = Filter()
 
     # Header record on first line
-    f.seek(0)
-    hd = Header(f.readline())
+    first_line = f.readline()
+    if first_line.startswith("HD") != True:
+        print("Error: not a CIF Schedule file!", file=sys.stderr)
+        sys.exit(1)
+    hd = Header(first_line)
     print("File mainframe id: {0}".format(hd.file_mainframe_identity))
     print("Time of extract: {0} {1}".format(
         hd.date_of_extract, hd.time_of_extract))
@@ -627,14 +1589,20 @@ def parse(f, connection):
     print(
         "User time window: {0} - {1}\n".format(hd.user_start_date, hd.user_end_date))
 
-    # Delete schedules ending before the time window
-    delete_old_schedules(connection, hd.user_start_date)
+    # Resolve STANOX ranges to the TIPLOCs already in the database
+    if filters.stanox_ranges:
+        filters.tiplocs |= writer.tiplocs_by_stanox(filters.stanox_ranges)
 
-    # Continuity check
-    last_ref = select_last_ref(connection)
-    if last_ref != None and last_ref != hd.last_file_reference:
-        print("Continuity error: last file ref did not match {0} in the database".format(
-            last_ref))
+    # Updates record what they change in the change log, full snapshots
+    # replace everything so readers must refresh in full anyway
+    log_changes = hd.update_indicator == "U"
+    cache_change_log = []
+
+    # Continuity check and deletion of schedules ending before the time window
+    try:
+        writer.begin(hd, log_changes)
+    except ContinuityError as e:
+        print(e, file=sys.stderr)
         sys.exit(1)
 
     # Use time the schedules were extracted on
@@ -649,19 +1617,60 @@ def parse(f, connection):
     cache_schedule_delete = []
 
     bs = None  # Basic Schedule
-
-    current_day = 0  # Current Day Num
-    last_processed_time = None  # Cache Last Time
+    skipping = False  # Rest of a filtered out schedule is skipped
+    pending = None  # Records held until a location in the area is seen
+    matched = False
 
     counter = Counter()
 
-    # Display a progress bar
-    pbar = tqdm(total=total_lines, desc="Processing")
+    def keep_schedule(bs):
+        cache_schedule_insert.append((schedule_row(bs), bs.locations, bs.changes))
+        if log_changes:
+            cache_change_log.append(("S", bs.transaction_type, bs.key()))
 
-    # Iterate line-by-line
-    f.seek(0)
-    for line in f:
+    def drop_schedule(bs):
+        # A revision that is filtered out leaves only its delete
+        if log_changes and bs.transaction_type == "R":
+            cache_change_log.append(("S", "D", bs.key()))
+
+    # Characters map one-to-one to bytes in ISO-8859-1
+    offset = 0
+
+    # Iterate line-by-line, the header included, without seeking so that
+    # the file can also be a decompressing network stream
+    for line in chain([first_line], f):
         record = line[0:2]
+        offset += len(line)
+
+        # A cancellation has no locations, it closes after its BX record
+        if bs is not None and bs.stp_indicator == "C" and record not in ("BX", "TN"):
+            keep_schedule(bs)
+            bs = None
+
+        # Skip the rest of a filtered out schedule without parsing it
+        if skipping and (record in LOCATION_RECORDS or record in ("BX", "TN", "LN")):
+            counter[record] += 1
+            if record == "LT":
+                skipping = False
+            continue
+
+        # Hold locations back until one of them is in the area
+        if pending is not None and record in LOCATION_RECORDS:
+            pending.append(line)
+            if line[2:9].rstrip() in filters.tiplocs:
+                matched = True
+            if record != "LT":
+                counter[record] += 1
+                continue
+            if not matched:
+                counter[record] += 1
+                drop_schedule(bs)
+                bs = None
+                pending = None
+                continue
+            for raw in pending[:-1]:
+                bs.add_record(raw[0:2], raw)
+            pending = None
 
         if record == "HD":  # Header Record
             counter.update(HD=1)
@@ -670,17 +1679,32 @@ def parse(f, connection):
             counter.update(TI=1)
             ti = Tiploc(line)
             cache_tiploc_insert.append(vars(ti))
+            if log_changes:
+                cache_change_log.append(("T", "N", [ti.new_tiploc]))
+            if filters.stanox_ranges:
+                filters.add_tiploc(ti)
 
         elif record == "TA":  # TIPLOC Amend
             counter.update(TA=1)
             ta = Tiploc(line)
             cache_tiploc_delete.append(vars(ta))
             cache_tiploc_insert.append(vars(ta))
+            if log_changes:
+                # An amend may rename the TIPLOC, the old code is then gone
+                if ta.new_tiploc != ta.tiploc_code:
+                    cache_change_log.append(("T", "D", [ta.tiploc_code]))
+                    cache_change_log.append(("T", "N", [ta.new_tiploc]))
+                else:
+                    cache_change_log.append(("T", "R", [ta.tiploc_code]))
+            if filters.stanox_ranges:
+                filters.add_tiploc(ta)
 
         elif record == "TD":  # TIPLOC Delete
             counter.update(TD=1)
             td = Tiploc(line)
             cache_tiploc_delete.append(vars(td))
+            if log_changes:
+                cache_change_log.append(("T", "D", [td.tiploc_code]))
 
         elif record == "AA":  # Associations
             counter.update(AA=1)
@@ -689,31 +1713,56 @@ def parse(f, connection):
             if aa.transaction_type == "D" or aa.transaction_type == "R":
                 cache_assoc_delete.append(vars(aa))
             # Append association for insertion if not a Delete
-            if aa.transaction_type != "D":
+            if aa.transaction_type != "D" and filters.association(aa):
                 cache_assoc_insert.append(vars(aa))
+                if log_changes:
+                    cache_change_log.append(("A", aa.transaction_type, aa.key()))
+            elif log_changes and aa.transaction_type != "N":
+                cache_change_log.append(("A", "D", aa.key()))
 
         elif record == "BS":  # Basic Schedule
             counter.update(BS=1)
+            # A schedule left without its LT record is not imported
+            if bs is not None:
+                drop_schedule(bs)
             bs = Schedule(line)
             bs.set_time(last_modified)
+            skipping = False
+            pending = None
             # Append revised/deleted schedule to cache for deletion
-            if bs.transaction_type == "D":
-                cache_schedule_delete.append(vars(bs))
-            elif bs.transaction_type == "R":
-                cache_schedule_delete.append(vars(bs))
-            # Append a STP cancellation for insertion (if not a delete)
-            if bs.stp_indicator == "C" and bs.transaction_type != "D":
-                cache_schedule_insert.append(vars(bs))
+            if bs.transaction_type == "D" or bs.transaction_type == "R":
+                cache_schedule_delete.append((bs.transaction_type, *bs.key()))
+                if log_changes and bs.transaction_type == "D":
+                    cache_change_log.append(("S", "D", bs.key()))
             # Clear cached schedule object after a delete
             if bs.transaction_type == "D":
                 bs = None
+            # Skip schedules outside the date window
+            elif not filters.dates(bs.schedule_start_date, bs.schedule_end_date):
+                drop_schedule(bs)
+                bs = None
+                skipping = True
+            # A STP cancellation has no locations and often no operator,
+            # so it is kept for the schedule it cancels
+            elif bs.stp_indicator == "C":
+                pass
+            elif filters.tiplocs is not None:
+                pending = []
+                matched = False
 
         elif record == "BX":  # Basic Schedule Extra Details
             counter.update(BX=1)
             if bs is None:
-                print("Logical error in CIF Schedule file!")
+                print("Logical error in CIF Schedule file!", file=sys.stderr)
                 exit(1)
             bs.set_bx(line)
+            # Skip schedules of other operators
+            if filters.atoc_codes is not None and bs.stp_indicator != "C":
+                if bs.atoc_code not in filters.atoc_codes:
+                    drop_schedule(bs)
+                    bs = None
+                    skipping = True
+                    pending = None
 
         elif record == "TN":  # Train specific note (Unused)
             counter.update(TN=1)
@@ -722,65 +1771,34 @@ def parse(f, connection):
         elif record == "LO":  # Location Origin
             counter.update(LO=1)
             if bs is None:
-                print("Logical error in CIF Schedule file!")
+                print("Logical error in CIF Schedule file!", file=sys.stderr)
                 exit(1)
-            lo = OriginLocation(line)
-            # Add location
-            bs.add_location(lo)
-            # It is day 0
-            lo.departure_day = 0
-            # Set departure as previous time
-            last_processed_time = lo.departure
+            bs.add_location(OriginLocation(line))
 
         elif record == "LI":  # Location Intermediate
             counter.update(LI=1)
             if bs is None:
-                print("Logical error in CIF Schedule file!")
+                print("Logical error in CIF Schedule file!", file=sys.stderr)
                 exit(1)
-            li = IntermediateLocation(line)
-            # Process arrival time
-            if li.arrival:
-                if last_processed_time is not None and li.arrival < last_processed_time:
-                    current_day += 1
-                li.arrival_day = current_day
-                last_processed_time = li.arrival
-            # Process departure time
-            if li.departure:
-                if last_processed_time is not None and li.departure < last_processed_time:
-                    current_day += 1
-                li.departure_day = current_day
-                last_processed_time = li.departure
-            # Add location
-            bs.add_location(li)
+            bs.add_location(IntermediateLocation(line))
 
         elif record == "LT":  # Location Terminus (Closes a Schedule)
             counter.update(LT=1)
             if bs is None:
-                print("Logical error in CIF Schedule file!")
+                print("Logical error in CIF Schedule file!", file=sys.stderr)
                 exit(1)
-            lt = TerminatingLocation(line)
-            # Process arrival time
-            if lt.arrival:
-                if last_processed_time is not None and lt.arrival < last_processed_time:
-                    current_day += 1
-                lt.arrival_day = current_day
-                last_processed_time = lt.arrival
-            # Add location
-            bs.add_location(lt)
+            bs.add_location(TerminatingLocation(line))
             # Append closed schedule to cache
-            cache_schedule_insert.append(vars(bs))
+            keep_schedule(bs)
             # Clear cached values
             bs = None
-            last_processed_time = None
-            current_day = 0  # Important!
 
         elif record == "CR":  # Change en route
             counter.update(CR=1)
             if bs is None:
-                print("Logical error in CIF Schedule file!")
+                print("Logical error in CIF Schedule file!", file=sys.stderr)
                 exit(1)
-            cr = ChangesEnRoute(line)
-            bs.add_changes(cr)
+            bs.add_changes(ChangesEnRoute(line))
 
         elif record == "LN":  # Location Note (Unused)
             counter.update(LN=1)
@@ -788,54 +1806,181 @@ def parse(f, connection):
 
         elif record == "ZZ":  # Trailer Record
             counter.update(ZZ=1)
-            pass
+            if bs is not None:
+                drop_schedule(bs)
+                bs = None
 
-        # Save objects to the database in chunks of 2000 items and at the end of the file
-        try:
-            len_ti = len(cache_tiploc_delete) + len(cache_tiploc_insert)
-            if (len_ti % 2000 == 0 and len_ti > 0) or (len_ti > 0 and record == "ZZ"):
-                delete_tiplocs(connection, cache_tiploc_delete)
-                insert_tiplocs(connection, cache_tiploc_insert)
-                cache_tiploc_delete.clear()
-                cache_tiploc_insert.clear()
-            len_aa = len(cache_assoc_delete) + len(cache_assoc_insert)
-            if (len_aa % 2000 == 0 and len_aa > 0) or (len_aa > 0 and record == "ZZ"):
-                delete_associations(connection, cache_assoc_delete)
-                insert_associations(connection, cache_assoc_insert)
-                cache_assoc_delete.clear()
-                cache_assoc_insert.clear()
-            len_bs = len(cache_schedule_delete) + len(cache_schedule_insert)
-            if (len_bs % 2000 == 0 and len_bs > 0) or (len_bs > 0 and record == "ZZ"):
-                delete_schedules(connection, cache_schedule_delete)
-                insert_schedules(connection, cache_schedule_insert)
-                cache_schedule_delete.clear()
-                cache_schedule_insert.clear()
-        except psycopg.Error as e:
-            print("SQL Error: {}".format(e.sqlstate))
-            print(e.diag.message_primary)
-            if e.diag.message_detail:
-                print(e.diag.message_detail)
-            print("Changes not committed")
-            connection.rollback()
-            connection.close()
-            sys.exit(1)
+        # Save objects to the database in chunks of batch_size items and at the end of the file
+        batch = {}
+        len_ti = len(cache_tiploc_delete) + len(cache_tiploc_insert)
+        if len_ti >= batch_size or (len_ti > 0 and record == "ZZ"):
+            batch["tiplocs"] = (cache_tiploc_delete, cache_tiploc_insert)
+            cache_tiploc_delete = []
+            cache_tiploc_insert = []
+        len_aa = len(cache_assoc_delete) + len(cache_assoc_insert)
+        if len_aa >= batch_size or (len_aa > 0 and record == "ZZ"):
+            batch["associations"] = (cache_assoc_delete, cache_assoc_insert)
+            cache_assoc_delete = []
+            cache_assoc_insert = []
+        len_bs = len(cache_schedule_delete) + len(cache_schedule_insert)
+        if len_bs >= batch_size or (len_bs > 0 and record == "ZZ"):
+            batch["schedules"] = (cache_schedule_delete, cache_schedule_insert)
+            cache_schedule_delete = []
+            cache_schedule_insert = []
+        len_cl = len(cache_change_log)
+        if len_cl >= batch_size or (len_cl > 0 and record == "ZZ"):
+            batch["change_log"] = (hd.current_file_reference, cache_change_log)
+            cache_change_log = []
+        if batch:
+            # Deletes of records never imported are expected when filtering
+            batch["report_missing"] = not filters.active
+            try:
+                writer.write(batch)
+            except psycopg.Error as e:
+                print("SQL Error: {}".format(e.sqlstate), file=sys.stderr)
+                print(e.diag.message_primary, file=sys.stderr)
+                if e.diag.message_detail:
+                    print(e.diag.message_detail, file=sys.stderr)
+                print("Changes not committed", file=sys.stderr)
+                writer.rollback()
+                writer.close()
+                sys.exit(1)
+            except sqlite3.Error as e:
+                print("SQL Error: {}".format(e), file=sys.stderr)
+                print("Changes not committed", file=sys.stderr)
+                writer.rollback()
+                writer.close()
+                sys.exit(1)
 
         # Update progress
-        pbar.update()
+        if offset >= progress.next_offset:
+            progress.update(offset)
 
     stats = json.dumps([{"record": key, "value": value}
                        for key, value in counter.items()])
-    insert_header(connection, {**vars(hd), **{"statistics": stats}})
-    pbar.close()
+    writer.finish({**vars(hd), **{"statistics": stats}},
+                  change_log_keep if log_changes else None)
+    progress.close(offset, records=dict(counter))
 
 
-def main():
-    ap = argparse.ArgumentParser(
-        prog="cifimport", description="CIF Schedule Import Tool", conflict_handler="resolve")
-    ap.add_argument("filename", help="read data from the file filename")
+# Network Rail data feed
 
-    # Postgres related arguments
-    ap.add_argument("-d", "--dbname", required=True,
+FEED_URL = "https://publicdatafeeds.networkrail.co.uk/ntrod/CifFileAuthenticate"
+FEED_DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def feed_url(base, day):
+    if day == "full":
+        query = {"type": "CIF_ALL_FULL_DAILY", "day": "toc-full.CIF.gz"}
+    else:
+        query = {"type": "CIF_ALL_UPDATE_DAILY",
+                 "day": "toc-update-{0}.CIF.gz".format(day)}
+    return "{0}?{1}".format(base, urlencode(query))
+
+
+def next_update_day(writer):
+    # Daily updates follow on from the day of the last extract
+    last = writer.select_last_extract()
+    if last is None:
+        return None
+    return FEED_DAYS[last.isoweekday() % 7]
+
+
+def open_feed(url, username, password):
+    request = Request(url)
+    token = b64encode("{0}:{1}".format(username, password).encode()).decode()
+    # Not passed on when the feed redirects to the file storage
+    request.add_unredirected_header("Authorization", "Basic {0}".format(token))
+    return urlopen(request, timeout=60)
+
+
+class Prefetcher(io.RawIOBase):
+    """Reads a stream on a background thread.
+
+    Keeps the download running while the parser is waiting for the database.
+    At most depth blocks are buffered.
+    """
+
+    def __init__(self, raw, size=65536, depth=256):
+        self.raw = raw
+        self.size = size
+        self.queue = Queue(depth)
+        self.buffer = b""
+        self.finished = False
+        self.bytes_read = 0
+        self.thread = Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        try:
+            for b in blocks(self.raw, self.size):
+                self.queue.put(b)
+            self.queue.put(b"")
+        except Exception as e:
+            self.queue.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer:
+            if self.finished:
+                return 0
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self.finished = True
+                return 0
+            self.buffer = item
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        self.bytes_read += n
+        return n
+
+
+def parse_feed(writer, url, username, password, mode="bar", change_log_keep=14, filters=None,
+               batch_size=2000):
+    print("Fetching {0}...".format(url))
+    try:
+        response = open_feed(url, username, password)
+    except HTTPError as e:
+        print("Error: feed returned HTTP {0} {1}".format(
+            e.code, e.reason), file=sys.stderr)
+        sys.exit(1)
+    except URLError as e:
+        print("Error: feed not reachable: {0}".format(e.reason), file=sys.stderr)
+        sys.exit(1)
+
+    with response:
+        length = response.headers.get("Content-Length")
+        length = int(length) if length else None
+        if length:
+            print("Download size: {0}".format(sizeof_fmt(length)))
+        prefetcher = Prefetcher(response)
+        # Download, decompression and parsing run in the same pass
+        stream = gzip.GzipFile(fileobj=io.BufferedReader(prefetcher))
+        with io.TextIOWrapper(stream, encoding="iso-8859-1", errors="ignore") as f:
+            progress = Progress(length, mode, source=lambda: prefetcher.bytes_read)
+            parse(f, writer, progress, change_log_keep, filters, batch_size)
+
+
+def comma_list(value):
+    return {v.strip() for v in value.split(",") if v.strip()}
+
+
+def stanox_range(value):
+    first, _, last = value.partition("-")
+    try:
+        return (int(first), int(last or first))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "{0} is not a STANOX range".format(value))
+
+
+def add_connection_arguments(ap, required=True):
+    ap.add_argument("-d", "--dbname", required=required,
                     help="specifies the name of the database to connect to")
     ap.add_argument(
         "-h",
@@ -847,7 +1992,7 @@ def main():
     ap.add_argument(
         "-p", "--port", default=5432, required=False, help="specifies the port on which the server is listening"
     )
-    ap.add_argument("-U", "--username", required=True,
+    ap.add_argument("-U", "--username", required=required,
                     help="connect to the database as the username")
     ap.add_argument(
         "-W",
@@ -856,6 +2001,46 @@ def main():
         action="store_true",
         help="prompt for a password before connecting to a database",
     )
+
+
+def connection_dsn(args):
+    # Postgres connection details
+    dsn = f"dbname={args.dbname} user={args.username} host={args.host} port={args.port}"
+    # Prompt for a password if requested
+    if args.password == True:
+        args.password = getpass(prompt="Password: ", stream=None)
+        dsn = f"{dsn} password={args.password}"
+    return dsn
+
+
+def target_name(dsn):
+    # user@host:port/dbname, without the password
+    info = conninfo_to_dict(dsn)
+    return "{0}@{1}:{2}/{3}".format(
+        info.get("user", ""), info.get("host", ""), info.get("port", ""), info.get("dbname", ""))
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        prog="cifimport", description="CIF Schedule Import Tool", conflict_handler="resolve")
+    ap.add_argument("filename", nargs="?",
+                    help="read data from the file filename")
+
+    # Postgres related arguments
+    add_connection_arguments(ap, required=False)
+    ap.add_argument(
+        "--dsn",
+        action="append",
+        required=False,
+        help="also import into the database of this connection string (repeatable)",
+    )
+    ap.add_argument(
+        "--sqlite",
+        metavar="FILE",
+        action="append",
+        required=False,
+        help="also import into this SQLite file, created with init_sqlite.sql if new (repeatable)",
+    )
     ap.add_argument(
         "--init",
         required=False,
@@ -864,50 +2049,222 @@ def main():
     )
     ap.add_argument("-t", required=False, action="store_true",
                     help="test only without committing")
+    ap.add_argument(
+        "--fetch",
+        metavar="DAY",
+        choices=["full", "next"] + FEED_DAYS,
+        required=False,
+        help="download and import from the Network Rail feed instead of a file: "
+        "full, an update day (mon..sun) or next (the update after the last import)",
+    )
+    ap.add_argument(
+        "--feed-url",
+        default=FEED_URL,
+        required=False,
+        help="specifies the feed address (default: %(default)s)",
+    )
+    ap.add_argument(
+        "--feed-username",
+        default=os.environ.get("NROD_USERNAME"),
+        required=False,
+        help="feed account user, or set NROD_USERNAME (password from NROD_PASSWORD or prompted)",
+    )
+    ap.add_argument(
+        "--change-log-keep",
+        type=int,
+        default=14,
+        required=False,
+        help="number of imports to keep in nrod.change_log (default: %(default)s)",
+    )
+    ap.add_argument(
+        "--batch-size",
+        type=int,
+        default=2000,
+        required=False,
+        help="number of records written to the database at a time (default: %(default)s)",
+    )
+    ap.add_argument(
+        "--loader",
+        choices=["insert", "copy"],
+        default="insert",
+        required=False,
+        help="write PostgreSQL rows with INSERT statements (default) or COPY",
+    )
+    ap.add_argument(
+        "--atoc",
+        type=comma_list,
+        required=False,
+        help="only import schedules of these operators, e.g. GW,XC",
+    )
+    ap.add_argument(
+        "--tiploc",
+        type=comma_list,
+        required=False,
+        help="only import schedules calling or passing at these TIPLOCs",
+    )
+    ap.add_argument(
+        "--stanox",
+        type=stanox_range,
+        action="append",
+        required=False,
+        help="like --tiploc for the TIPLOCs in a STANOX range, e.g. 87000-87999 (repeatable)",
+    )
+    ap.add_argument(
+        "--from",
+        dest="date_from",
+        type=date.fromisoformat,
+        required=False,
+        help="only import records running on or after this date (YYYY-MM-DD)",
+    )
+    ap.add_argument(
+        "--to",
+        dest="date_to",
+        type=date.fromisoformat,
+        required=False,
+        help="only import records running on or before this date (YYYY-MM-DD)",
+    )
+    ap.add_argument(
+        "--progress",
+        choices=["bar", "json", "none"],
+        required=False,
+        help="progress reporting: a progress bar (default), JSON lines on stderr, or none",
+    )
+    ap.add_argument(
+        "-q",
+        "--quiet",
+        required=False,
+        action="store_true",
+        help="only print errors (implies --progress none unless given)",
+    )
     args = ap.parse_args()
+    if args.dsn is None and args.sqlite is None and args.dbname is None:
+        ap.error("the following arguments are required: -d/--dbname, -U/--username (or --dsn or --sqlite)")
+    if args.dbname is not None and args.username is None:
+        ap.error("-d/--dbname needs -U/--username")
+    if (args.filename is None) == (args.fetch is None):
+        ap.error("give either a filename or --fetch")
+    if args.fetch is not None and not args.feed_username:
+        ap.error("--fetch needs --feed-username or NROD_USERNAME")
+    if args.progress is None:
+        args.progress = "none" if args.quiet else "bar"
+
+    if args.quiet == True:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            run(args)
+    else:
+        run(args)
+
+
+def run(args):
 
     # Check if the file exists
-    if os.path.isfile(args.filename) != True:
-        print("Error: {0} is not a file!".format(args.filename))
+    if args.filename is not None and os.path.isfile(args.filename) != True:
+        print("Error: {0} is not a file!".format(args.filename), file=sys.stderr)
         sys.exit(1)
 
-    # Postgres connection details
-    dsn = f"dbname={args.dbname} user={args.username} host={args.host} port={args.port}"
-    # Prompt for a password if requested
-    if args.password == True:
-        args.password = getpass(prompt="Password: ", stream=None)
-        dsn = f"{dsn} password={args.password}"
+    # Feed password
+    if args.fetch is not None:
+        feed_password = os.environ.get("NROD_PASSWORD")
+        if not feed_password:
+            # Unattended runs cannot be prompted
+            if not sys.stdin.isatty():
+                print("Error: no feed password, set NROD_PASSWORD", file=sys.stderr)
+                sys.exit(1)
+            feed_password = getpass(prompt="Feed password: ", stream=None)
+
+    # Records to import
+    filters = Filter(
+        atoc_codes=args.atoc,
+        tiplocs=args.tiploc,
+        stanox_ranges=args.stanox,
+        date_from=args.date_from.isoformat() if args.date_from else None,
+        date_to=args.date_to.isoformat() if args.date_to else None,
+    )
+
+    dsns = [connection_dsn(args)] if args.dbname is not None else []
+    dsns.extend(args.dsn or [])
+
+    with ExitStack() as stack:
+        # Create a connection per target
+        writers = []
+        for dsn in dsns:
+            name = target_name(dsn)
+            try:
+                connection = stack.enter_context(psycopg.connect(dsn))
+            except psycopg.Error as e:
+                print("{0}: could not connect: {1}".format(name, e), file=sys.stderr)
+                sys.exit(1)
+            writers.append(PostgresWriter(connection, name, args.loader))
+        for path in args.sqlite or []:
+            w = SqliteWriter(path)
+            stack.callback(w.connection.close)
+            writers.append(w)
 
-    # Create a connection
-    with psycopg.connect(dsn) as connection:
         # Truncate tables if requested
         if args.init == True and args.t != True:
-            # ask for permission
-            if not input("Init replaces old data. Are you sure? (y/n): ").lower().strip()[:1] == "y":
+            # ask for permission, on stderr so that -q does not hide the prompt
+            print("Init replaces old data. Are you sure? (y/n): ", end="",
+                  file=sys.stderr, flush=True)
+            answer = sys.stdin.readline()
+            if not answer.lower().strip()[:1] == "y":
                 sys.exit(1)
             print("Truncating tables...")
-            truncate_tables(connection)
-            connection.commit()
-
-        # Process the file
-        with open(args.filename, "r", encoding="iso-8859-1", errors="ignore") as f:
-            file_size = sizeof_fmt(os.stat(args.filename).st_size)
-            print("Reading data from {0}...".format(args.filename))
-            print("Size on disk: {0}".format(file_size))
-
-            first_line = f.readline()
-
-            if first_line.startswith("HD") != True:
-                print("Error: {0} is not a CIF Schedule file!".format(
-                    args.filename))
-                sys.exit(1)
-
-            parse(f, connection)
-            # If a test then rollback otherwise commit
-            if args.t == True:
-                connection.rollback()
-            else:
-                connection.commit()
+            for w in writers:
+                w.truncate_tables()
+                w.commit()
+
+        # The file is parsed once, several targets are written concurrently
+        writer = writers[0] if len(writers) == 1 else FanOutWriter(writers)
+
+        if args.fetch is not None:
+            # Download and process the feed
+            day = args.fetch
+            if day == "next":
+                # Each target still checks that the update follows on
+                day = next_update_day(writers[0])
+                if day is None:
+                    print("Error: no previous import, fetch a full snapshot first",
+                          file=sys.stderr)
+                    sys.exit(1)
+            parse_feed(writer, feed_url(args.feed_url, day),
+                       args.feed_username, feed_password, args.progress,
+                       args.change_log_keep, filters, args.batch_size)
+        else:
+            # Process the file
+            with open(args.filename, "r", encoding="iso-8859-1", errors="ignore") as f:
+                file_size = os.stat(args.filename).st_size
+                print("Reading data from {0}...".format(args.filename))
+                print("Size on disk: {0}".format(sizeof_fmt(file_size)))
+
+                parse(f, writer, Progress(file_size, args.progress),
+                      args.change_log_keep, filters, args.batch_size)
+        writer.close()
+
+        # If a test then rollback otherwise commit
+        for w in writers:
+            if w.name in writer.failures:
+                continue
+            # A failed commit leaves the other targets to be committed
+            try:
+                if args.t == True:
+                    w.rollback()
+                else:
+                    w.commit()
+            except psycopg.Error as e:
+                writer.failures[w.name] = "SQL Error: {0} {1}".format(
+                    e.sqlstate, e.diag.message_primary or e)
+                continue
+            except sqlite3.Error as e:
+                writer.failures[w.name] = "SQL Error: {0}".format(e)
+                continue
+            if len(writers) > 1:
+                print("{0}: {1}".format(
+                    w.name, "rolled back" if args.t == True else "committed"))
+        for name, message in writer.failures.items():
+            print("{0}: failed, changes not committed: {1}".format(
+                name, message), file=sys.stderr)
+        if writer.failures:
+            sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -43,6 +43,9 @@ CREATE TABLE IF NOT EXISTS nrod.association (
     UNIQUE (main_train_uid, assoc_train_uid, assoc_start_date, diagram_type, location, base_location_suffix, assoc_location_suffix, stp_indicator)
 );
 
+-- Natural key of association deletes
+CREATE INDEX ON nrod.association (main_train_uid, assoc_train_uid, assoc_start_date, location, stp_indicator);
+
 -- BS/BX Records (Schedule)
 CREATE TABLE IF NOT EXISTS nrod.schedule (
     id                          integer PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
@@ -115,3 +118,15 @@ CREATE TABLE IF NOT EXISTS nrod.changes_en_route (
 );
 
 CREATE INDEX ON nrod.changes_en_route (schedule_id);
+
+-- Change log of update imports, keyed by header current_file_reference
+-- entity: T (tiploc), A (association), S (schedule)
+-- transaction_type: N (new), R (revise), D (delete)
+CREATE TABLE IF NOT EXISTS nrod.change_log (
+    file_reference              text not null,
+    entity                      text not null,
+    transaction_type            text not null,
+    key                         text[] not null
+);
+
+CREATE INDEX ON nrod.change_log (file_reference);
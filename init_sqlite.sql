@@ -0,0 +1,132 @@
+-- SQLite version of init.sql, used by cifimport.py --sqlite
+-- dates are YYYY-MM-DD and times HH:MM:SS text, bit(7) days are text,
+-- booleans are 0/1, and jsonb/text[] columns hold JSON text
+
+-- File headers
+CREATE TABLE IF NOT EXISTS header (
+    file_mainframe_identity     text,
+    date_of_extract             text,
+    time_of_extract             text,
+    current_file_reference      text,
+    last_file_reference         text,
+    update_indicator            text,
+    user_start_date             text,
+    user_end_date               text,
+    statistics                  text
+);
+
+-- T Records (Timing Point Location)
+CREATE TABLE IF NOT EXISTS tiploc (
+    tiploc_code                 text PRIMARY KEY,
+    nalco                       integer,
+    check_char                  text,
+    tps_description             text,
+    stanox                      integer,
+    crs_code                    text,
+    description                 text
+);
+
+-- AA Records (Association)
+CREATE TABLE IF NOT EXISTS association (
+    id                          integer PRIMARY KEY,
+    main_train_uid              text not null,
+    assoc_train_uid             text not null,
+    assoc_start_date            text not null,
+    assoc_end_date              text not null,
+    assoc_days                  text not null,
+    category                    text,
+    date_indicator              text,
+    location                    text not null,
+    base_location_suffix        integer,
+    assoc_location_suffix       integer,
+    diagram_type                text not null DEFAULT 'T',
+    association_type            text,
+    stp_indicator               text not null,
+    UNIQUE (main_train_uid, assoc_train_uid, assoc_start_date, diagram_type, location, base_location_suffix, assoc_location_suffix, stp_indicator)
+);
+
+-- Natural key of association deletes
+CREATE INDEX IF NOT EXISTS association_key_idx ON association (main_train_uid, assoc_train_uid, assoc_start_date, location, stp_indicator);
+
+-- BS/BX Records (Schedule)
+CREATE TABLE IF NOT EXISTS schedule (
+    id                          integer PRIMARY KEY,
+    is_vstp                     integer not null DEFAULT 0,
+    train_uid                   text not null,
+    schedule_start_date         text not null,
+    schedule_end_date           text,
+    schedule_days_runs          text,
+    train_status                text,
+    train_category              text,
+    signalling_id               text,
+    train_service_code          integer,
+    power_type                  text,
+    timing_load                 text,
+    speed                       integer,
+    operating_characteristics   text,
+    train_class                 text,
+    sleepers                    text,
+    reservations                text,
+    catering_code               text,
+    service_branding            text,
+    stp_indicator               text not null,
+    uic_code                    text,
+    atoc_code                   text,
+    applicable_timetable        integer,
+    last_modified               text,
+    UNIQUE (train_uid, schedule_start_date, stp_indicator, is_vstp)
+);
+
+-- LO/LI/LT Records (Location)
+CREATE TABLE IF NOT EXISTS schedule_location (
+    schedule_id                 integer REFERENCES schedule (id) ON DELETE CASCADE,
+    position                    integer,
+    tiploc_code                 text not null,
+    tiploc_instance             integer,
+    arrival_day                 integer,
+    departure_day               integer,
+    arrival                     text,
+    departure                   text,
+    public_arrival              text,
+    public_departure            text,
+    platform                    text,
+    line                        text,
+    path                        text,
+    activity                    text,
+    engineering_allowance       text,
+    pathing_allowance           text,
+    performance_allowance       text,
+    PRIMARY KEY (schedule_id, position)
+) WITHOUT ROWID;
+
+-- CR Record (Changes En Route)
+CREATE TABLE IF NOT EXISTS changes_en_route (
+    schedule_id                 integer REFERENCES schedule (id) ON DELETE CASCADE,
+    tiploc_code                 text not null,
+    tiploc_instance             integer,
+    train_category              text,
+    signalling_id               text,
+    train_service_code          integer,
+    power_type                  text,
+    timing_load                 text,
+    speed                       integer,
+    operating_characteristics   text,
+    train_class                 text,
+    sleepers                    text,
+    reservations                text,
+    catering_code               text,
+    service_branding            text,
+    uic_code                    text
+);
+
+CREATE INDEX IF NOT EXISTS changes_en_route_schedule_id_idx ON changes_en_route (schedule_id);
+
+-- Change log of update imports, keyed by header current_file_reference
+CREATE TABLE IF NOT EXISTS change_log (
+    file_reference              text not null,
+    entity                      text not null,
+    transaction_type            text not null,
+    key                         text not null
+);
+
+CREATE INDEX IF NOT EXISTS change_log_file_reference_idx ON change_log (file_reference);
@@ -0,0 +1,310 @@
+"""In-memory timetable queries over the nrod tables written by cifimport.
+
+    with psycopg.connect(dsn) as connection:
+        tt = Timetable()
+        tt.refresh(connection)
+        tt.departures("PADTON", date(2024, 1, 15), time(8, 0), time(9, 0))
+        tt.calling_pattern("C12345", date(2024, 1, 15))
+
+Call refresh() again whenever fresh data may have been imported, it only
+reloads when the latest header's current_file_reference has changed. The
+connection must not be inside a transaction, refresh() runs its own.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import date, time, timedelta
+import sys
+
+Call = namedtuple(
+    "Call",
+    [
+        "tiploc_code",
+        "arrival",
+        "departure",
+        "public_arrival",
+        "public_departure",
+        "arrival_day",
+        "departure_day",
+        "platform",
+        "activity",
+    ],
+)
+
+Departure = namedtuple(
+    "Departure",
+    [
+        "train_uid",
+        "signalling_id",
+        "atoc_code",
+        "departure",
+        "public_departure",
+        "platform",
+        "destination",
+    ],
+)
+
+Association = namedtuple(
+    "Association",
+    [
+        "main_train_uid",
+        "assoc_train_uid",
+        "category",
+        "date_indicator",
+        "location",
+        "association_type",
+        "stp_indicator",
+    ],
+)
+
+DAY = 86400
+NO_TIME = -1
+
+# Rows fetched per round trip by server-side cursors
+ITERSIZE = 100000
+
+
+# Helper Functions
+
+
+def seconds(t):
+    return NO_TIME if t is None else t.hour * 3600 + t.minute * 60 + t.second
+
+
+def to_time(s):
+    return None if s == NO_TIME else time(s // 3600, s // 60 % 60, s % 60)
+
+
+def days_mask(days):
+    # bit(7) runs Monday to Sunday, bit n is set for isoweekday n + 1
+    return sum(1 << i for i, c in enumerate(days or "") if c == "1")
+
+
+def runs_on(start, end, mask, d):
+    o = d.toordinal()
+    return start <= o <= end and mask & (1 << d.weekday()) != 0
+
+
+# Database functions
+
+
+def select_current_ref(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """SELECT current_file_reference
+            FROM nrod.header
+            ORDER BY date_of_extract DESC, time_of_extract DESC LIMIT 1;"""
+        )
+        one = cursor.fetchone()
+        if one:
+            return one[0]
+    return None
+
+
+# Timetable
+
+
+class Timetable:
+    """Indexes of the imported timetable held in compact arrays.
+
+    Schedules are numbered in id order. Their locations are stored flat,
+    schedule n owning locations loc_start[n] to loc_start[n + 1]. Departures
+    are indexed per TIPLOC by departure_day * 86400 + seconds past midnight,
+    passing points are not indexed.
+    """
+
+    def __init__(self):
+        self.ref = None
+        # Schedules
+        self.train_uid = []
+        self.signalling_id = []
+        self.atoc_code = []
+        self.stp_indicator = []
+        self.is_vstp = array("b")
+        self.start = array("i")
+        self.end = array("i")
+        self.days = array("B")
+        self.loc_start = array("I", [0])
+        self.by_uid = {}
+        # Locations
+        self.tiploc_code = []
+        self.platform = []
+        self.activity = []
+        self.arrival = array("i")
+        self.departure = array("i")
+        self.public_arrival = array("i")
+        self.public_departure = array("i")
+        self.arrival_day = array("b")
+        self.departure_day = array("b")
+        self.loc_schedule = array("I")
+        # Departures per TIPLOC: (sorted keys, location numbers)
+        self.departures_at = {}
+        # Associations per location
+        self.associations = {}
+
+    def refresh(self, connection):
+        # The reference and every table are read from one snapshot, so an
+        # import committing meanwhile is either seen whole or not at all
+        with connection.transaction():
+            connection.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+            ref = select_current_ref(connection)
+            if ref == self.ref and ref is not None:
+                return False
+            self.__init__()
+            self.load(connection)
+            self.ref = ref
+        return True
+
+    def load(self, connection):
+        intern = sys.intern
+        numbers = {}
+
+        with connection.cursor(name="timetable_schedule") as cursor:
+            cursor.itersize = ITERSIZE
+            cursor.execute(
+                """SELECT id, train_uid, signalling_id, atoc_code, stp_indicator,
+                is_vstp, schedule_start_date, schedule_end_date,
+                schedule_days_runs::text
+                FROM nrod.schedule ORDER BY id;"""
+            )
+            for n, row in enumerate(cursor):
+                numbers[row[0]] = n
+                self.train_uid.append(intern(row[1]))
+                self.signalling_id.append(row[2])
+                self.atoc_code.append(intern(row[3]) if row[3] else None)
+                self.stp_indicator.append(intern(row[4]))
+                self.is_vstp.append(row[5])
+                self.start.append(row[6].toordinal())
+                # Open ended schedules run until further notice
+                self.end.append(row[7].toordinal() if row[7] else date.max.toordinal())
+                self.days.append(days_mask(row[8]))
+                self.by_uid.setdefault(row[1], []).append(n)
+
+        departures = {}
+        with connection.cursor(name="timetable_location") as cursor:
+            cursor.itersize = ITERSIZE
+            cursor.execute(
+                """SELECT schedule_id, tiploc_code, platform, activity,
+                arrival, departure, public_arrival, public_departure,
+                arrival_day, departure_day, position
+                FROM nrod.schedule_location ORDER BY schedule_id, position;"""
+            )
+            current = 0
+            for i, row in enumerate(cursor):
+                n = numbers[row[0]]
+                # Close off schedules up to this one, cancellations have no locations
+                while current < n:
+                    self.loc_start.append(i)
+                    current += 1
+                self.tiploc_code.append(intern(row[1]))
+                self.platform.append(intern(row[2]) if row[2] else None)
+                self.activity.append(intern(row[3]) if row[3] else None)
+                self.arrival.append(seconds(row[4]))
+                self.departure.append(seconds(row[5]))
+                self.public_arrival.append(seconds(row[6]))
+                self.public_departure.append(seconds(row[7]))
+                self.arrival_day.append(row[8] or 0)
+                self.departure_day.append(row[9] or 0)
+                self.loc_schedule.append(n)
+                # Intermediate locations without an arrival are passes, their
+                # departure column holds the pass time
+                if row[5] is not None and (row[10] == 0 or row[4] is not None):
+                    key = (row[9] or 0) * DAY + self.departure[i]
+                    departures.setdefault(self.tiploc_code[i], []).append((key, i))
+            while current < len(self.train_uid):
+                self.loc_start.append(len(self.tiploc_code))
+                current += 1
+
+        for tiploc, entries in departures.items():
+            entries.sort()
+            self.departures_at[tiploc] = (
+                array("i", (k for k, _ in entries)),
+                array("I", (i for _, i in entries)),
+            )
+
+        with connection.cursor(name="timetable_association") as cursor:
+            cursor.itersize = ITERSIZE
+            cursor.execute(
+                """SELECT main_train_uid, assoc_train_uid, category, date_indicator,
+                location, association_type, stp_indicator,
+                assoc_start_date, assoc_end_date, assoc_days::text
+                FROM nrod.association;"""
+            )
+            for row in cursor:
+                a = Association(*(intern(v) if v else v for v in row[:7]))
+                validity = (row[7].toordinal(), row[8].toordinal(), days_mask(row[9]))
+                self.associations.setdefault(a.location, []).append((a, validity))
+
+    def schedule_on(self, train_uid, d):
+        # The valid schedule with the lowest STP indicator (C, N, O, P) wins,
+        # VSTP schedules winning ties
+        best = None
+        for n in self.by_uid.get(train_uid, ()):
+            if not runs_on(self.start[n], self.end[n], self.days[n], d):
+                continue
+            rank = (self.stp_indicator[n], not self.is_vstp[n])
+            if best is None or rank < best[0]:
+                best = (rank, n)
+        if best is None or self.stp_indicator[best[1]] == "C":
+            return None
+        return best[1]
+
+    def calling_pattern(self, train_uid, d):
+        n = self.schedule_on(train_uid, d)
+        if n is None:
+            return None
+        return [self.call(i) for i in range(self.loc_start[n], self.loc_start[n + 1])]
+
+    def call(self, i):
+        return Call(
+            self.tiploc_code[i],
+            to_time(self.arrival[i]),
+            to_time(self.departure[i]),
+            to_time(self.public_arrival[i]),
+            to_time(self.public_departure[i]),
+            self.arrival_day[i],
+            self.departure_day[i],
+            self.platform[i],
+            self.activity[i],
+        )
+
+    def departures(self, tiploc, d, start=time(0), end=None, public_only=False):
+        keys, locations = self.departures_at.get(tiploc, ((), ()))
+        lo = seconds(start)
+        hi = seconds(end) if end is not None else DAY
+        result = []
+        # Trains leaving on date d may have started one or more days before
+        for day in range(0, (keys[-1] // DAY) + 1 if keys else 0):
+            first = bisect_left(keys, day * DAY + lo)
+            last = bisect_left(keys, day * DAY + hi)
+            origin_date = d - timedelta(days=day)
+            for i in locations[first:last]:
+                if public_only and self.public_departure[i] == NO_TIME:
+                    continue
+                n = self.loc_schedule[i]
+                if self.schedule_on(self.train_uid[n], origin_date) != n:
+                    continue
+                result.append(
+                    Departure(
+                        self.train_uid[n],
+                        self.signalling_id[n],
+                        self.atoc_code[n],
+                        to_time(self.departure[i]),
+                        to_time(self.public_departure[i]),
+                        self.platform[i],
+                        self.tiploc_code[self.loc_start[n + 1] - 1],
+                    )
+                )
+        result.sort(key=lambda r: r.departure)
+        return result
+
+    def associations_on(self, location, d):
+        best = {}
+        for a, (start, end, mask) in self.associations.get(location, ()):
+            if not (start <= d.toordinal() <= end and mask & (1 << d.weekday())):
+                continue
+            key = (a.main_train_uid, a.assoc_train_uid)
+            if key not in best or a.stp_indicator < best[key].stp_indicator:
+                best[key] = a
+        return [a for a in best.values() if a.stp_indicator != "C"]